@@ -1,15 +1,29 @@
 import streamlit as st
-import requests
 import json
 import time
-from concurrent.futures import ThreadPoolExecutor
+import copy
+import threading
+import queue
+import asyncio
+import random
+import collections
+import httpx
+from concurrent.futures import CancelledError, FIRST_COMPLETED, wait as futures_wait
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import os
 import hashlib
+import tempfile
+import contextlib
+import gc
+import re
+import bisect
+import unicodedata
 
 #Adding the llama parse dependency requirements.
 from llama_parse import LlamaParse
 import nest_asyncio
 nest_asyncio.apply()  # Needed for Streamlit compatibility
+from pypdf import PdfReader, PdfWriter
 
 LLAMAPARSE_API_KEY = st.secrets["LLAMAPARSE_API_KEY"]
 #Test to see if its uploaded
@@ -45,7 +59,9 @@ st.set_page_config(
 
 # API Authentication and Endpoints from documentation
 API_KEY = st.secrets["API_KEY"]
-API_BASE_URL = "https://app.wordware.ai/api/released-app"
+# Override with API_BASE_URL (environment or secrets) to point at a local wordware_standin.py server
+WORDWARE_API_BASE_URL = "https://app.wordware.ai/api/released-app"
+API_BASE_URL = os.environ.get("API_BASE_URL") or st.secrets.get("API_BASE_URL", WORDWARE_API_BASE_URL)
 
 APP_IDS = {
     "compendio_to_markdown": "ac114c48-be3a-4ab5-98ee-02a7d11c8dd7",
@@ -63,6 +79,152 @@ APP_IDS = {
     "table_generator": "660116bf-1f90-496b-aa12-d357044867ef" 
 }
 
+# Keep-alive connections held open to the Wordware API (shared by every session)
+HTTP_POOL_SIZE = int(st.secrets.get("HTTP_POOL_SIZE", 10))
+WORDWARE_TIMEOUT = 1600  # seconds; increased because of 2.3 mapping
+
+# Retry policy for dropped, stalled or throttled Wordware streams
+WORDWARE_MAX_RETRIES = 3
+WORDWARE_BACKOFF_BASE = 2  # seconds, doubled on every attempt
+WORDWARE_BACKOFF_MAX = 60  # seconds
+# Seconds without an NDJSON line before reconnecting. A reconnect restarts the run from scratch, so by default
+# it's as long as WORDWARE_TIMEOUT (mapping apps can stay silent for a long time); override it in secrets,
+# or per app name with a [WORDWARE_STALL_TIMEOUTS] table
+WORDWARE_STALL_TIMEOUT = float(st.secrets.get("WORDWARE_STALL_TIMEOUT", WORDWARE_TIMEOUT))
+WORDWARE_APP_STALL_TIMEOUTS = {name: float(seconds) for name, seconds in st.secrets.get("WORDWARE_STALL_TIMEOUTS", {}).items()}
+WORDWARE_RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Process-wide limits per APP_IDS entry; every session shares the same API key
+WORDWARE_DEFAULT_LIMITS = {"concurrency": 4, "rate_per_minute": 30, "burst": 4}
+WORDWARE_APP_LIMITS = {
+    # Chunked Stage 2 sends one call per compendio section
+    "mapping_referencias": {"concurrency": 4, "rate_per_minute": 20, "burst": 4},
+    "mapping_citas": {"concurrency": 4, "rate_per_minute": 20, "burst": 4},
+    "mapping_tablas": {"concurrency": 4, "rate_per_minute": 20, "burst": 4},
+    "theme_selector": {"concurrency": 3, "rate_per_minute": 12, "burst": 3},
+    "chapter_creator": {"concurrency": 6, "rate_per_minute": 30, "burst": 6},
+}
+# Fair-share weights: an interactive call costs a session less of its share than a bulk one
+PRIORITY_WEIGHTS = {"interactive": 4.0, "bulk": 1.0}
+
+# Streamed text is buffered and sent to the browser at most this often / once this much piles up
+STREAM_FLUSH_INTERVAL = 0.1  # seconds
+STREAM_FLUSH_BYTES = 2048
+RENDER_STATS_HISTORY = 20  # calls kept for the sidebar throughput readout
+
+# Reverse lookup so settings and logs can refer to apps by name
+APP_NAMES = {app_id: name for name, app_id in APP_IDS.items()}
+
+# On-disk cache of finished Wordware runs, keyed by app + canonical input hash
+WORDWARE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "wordware")
+WORDWARE_CACHE_MAX_BYTES = 500 * 1024 * 1024
+WORDWARE_CACHE_TTL = 7 * 24 * 3600  # seconds
+WORDWARE_CACHE_BYPASS_APPS = ["chapter_creator", "arcoNarrativo"]  # apps that should always produce fresh text
+
+# On-disk cache of LlamaParse output, keyed by PDF hash + parsing instruction + result type
+LLAMAPARSE_RESULT_TYPE = "markdown"
+PARSE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "llamaparse")
+PARSE_CACHE_MAX_BYTES = 200 * 1024 * 1024
+PARSE_CACHE_TTL = 30 * 24 * 3600  # seconds
+
+# Uploads are copied to disk once, in slices of this size, and every parser reads that copy
+UPLOAD_SPOOL_CHUNK = 1024 * 1024
+
+# Public file hosts are raced: the most reliable starts first, then another every UPLOAD_RACE_STAGGER seconds
+UPLOAD_TIMEOUT = 60  # seconds per service
+UPLOAD_RACE_STAGGER = 3  # seconds
+UPLOAD_STATS_WINDOW = 20  # recent attempts per service used for ranking
+# Hosted URLs by file SHA-256, reused while they have at least UPLOAD_URL_MIN_REMAINING seconds left
+UPLOAD_URL_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "uploads")
+UPLOAD_URL_CACHE_MAX_BYTES = 1024 * 1024
+UPLOAD_URL_MIN_REMAINING = 30 * 60
+# With 'Host large inputs' on, inputs at least this big are sent to Wordware by URL (see hosted_input)
+HOSTED_INPUT_MIN_BYTES = 256 * 1024
+
+# PDFs longer than PARSE_SHARD_MIN_PAGES are split into page ranges parsed concurrently
+PARSE_SHARD_MIN_PAGES = 100
+PARSE_SHARD_PAGES = 50
+PARSE_SHARD_WORKERS = 4
+PARSE_SHARD_MAX_RETRIES = 2  # per page range
+
+# Parsers join pages with a form feed so normalization can tell them apart
+PAGE_BREAK = "\n\n\f\n\n"
+
+# Normalization of parsed documents before they're sent to any stage. Running headers and footers are
+# lines repeated within NORMALIZE_EDGE_LINES of the top or bottom of at least NORMALIZE_BOILERPLATE_SHARE
+# of the pages (and NORMALIZE_BOILERPLATE_MIN_PAGES pages)
+NORMALIZE_EDGE_LINES = 3
+NORMALIZE_BOILERPLATE_MIN_PAGES = 3
+NORMALIZE_BOILERPLATE_SHARE = 0.3
+NORMALIZE_BOILERPLATE_MAX_CHARS = 120
+NORMALIZE_DUPLICATE_MIN_CHARS = 100  # shorter pages are never dropped as duplicates
+NORMALIZE_KEEP_LINE = re.compile(r"^\s*(?:\||\W*(?:fuente|source|nota|note)s?\b)", re.IGNORECASE)  # table rows and source notes always stay
+PAGE_NUMBER_LINE = re.compile(r"^[-–—\s]*(?:(?:page|p[aá]g(?:ina)?\.?)\s*)?\d{1,4}(?:\s*(?:of|de|/)\s*\d{1,4})?[-–—\s]*$", re.IGNORECASE)
+
+# Wordware apps that turn a hosted PDF into markdown, per document: (app name, PDF input name).
+# The two compendio apps each return part of the text, so their outputs are joined in order
+WORDWARE_PARSER_APPS = {
+    "compendio": [("compendio_to_markdown", "CompendioPDF"), ("compendio_to_markdown2", "CompendioPDF")],
+    "project_brief": [("project_brief_to_markdown", "ProjectBriefPDF")],
+}
+
+# Backends raced by the hedged and best-of parse modes; pages are streamed from the first one
+PARSE_RACE_ENGINES = ["llamaparse", "wordware"]
+PARSE_GOOD_CHARS_PER_PAGE = 1500  # text per page that counts as full coverage in parse_quality
+PARSE_ACCEPT_SCORE = 0.3  # parse_quality a result needs to win a hedged race
+PARSE_BEST_OF_GRACE = 60  # seconds best-of waits for the other backends after the first acceptable result
+
+# Chunked Stage 2 sends the mapping apps the compendio in sections of at most this size, split at headings
+MAPPING_SECTION_CHARS = 40000
+MAPPING_HEADING_LINE = re.compile(r"^#{1,6}\s", re.MULTILINE)
+# Parts of the combined mapping (mapping_logic's Merger.output) that later stages read
+MERGED_MAPPING_PARTS = ("referencias", "citas", "tablas")
+
+# Local citation extraction (see extract_citation_index). Surnames are runs of up to five capitalized words,
+# possibly joined by a particle ('Ministerio de Salud'); years may carry a letter ('2019a') or be 's. f.'
+CITATION_SURNAME = r"(?:(?:de|del|van|von|da|di|dos|le)[ \t]+)?[A-ZÁÉÍÓÚÑÜ][\w'’-]+(?:[ \t]+(?:(?:de|del|la|las|los)[ \t]+)*[A-ZÁÉÍÓÚÑÜ][\w'’-]+){0,4}"
+CITATION_YEAR = r"(?:1[6-9]|20)\d{2}[a-z]?\b|s\.[ \t]?f\.|n\.[ \t]?d\."
+CITATION_AUTHORS = (r"(?P<surname>" + CITATION_SURNAME + r")(?:(?:,[ \t]*|[ \t]+(?:y|e|and|&)[ \t]+)" + CITATION_SURNAME
+                    + r")*(?:,?[ \t]+(?:et[ \t]+al\.?|y[ \t]+cols?\.?))?")
+CITATION_YEARS = rf"(?:{CITATION_YEAR})(?:[ \t]*,[ \t]*(?:{CITATION_YEAR}))*"
+# Any parentheses with a year in them, whose parts CITATION_PART reads. When they hold just years, as in
+# 'García y López (2019)', the authors are read backwards from them with CITATION_NARRATIVE_AUTHORS
+CITATION_PATTERN = re.compile(r"\((?P<paren>[^()\n]*?\b(?:(?:1[6-9]|20)\d{2}|s\.[ \t]?f\.|n\.[ \t]?d\.)[^()\n]*)\)")
+CITATION_NARRATIVE_YEARS = re.compile(rf"(?P<n_years>{CITATION_YEARS})(?:,[ \t]*(?:p|pp|págs?)\.[^()\n]*)?")
+# Capitalized words that open a sentence before the authors ('Según García (2019)') rather than being part of them
+CITATION_LEADING_WORDS = (r"(?:Según|También|Además|Asimismo|Así|Como|Para|Pero|Aunque|Incluso|Mientras|Cuando|Donde|"
+                          r"Luego|Ya|En|Con|Por|Desde|Tras|Sobre|Entre|Sin|Ante|Este|Esta|Estos|Estas|El|La|Los|Las|"
+                          r"Un|Una|Del|Al|Y|O|Véase|Ver|According|As|In|For|Also|The|See)\b")
+CITATION_NARRATIVE_AUTHORS = re.compile(rf"\b(?!{CITATION_LEADING_WORDS}){CITATION_AUTHORS}[ \t]+$")
+# How far back from '(2019)' the authors of a narrative citation may start
+CITATION_AUTHORS_WINDOW = 200
+CITATION_PART = re.compile(rf"\s*(?:(?:e\.\s?g\.|p\.\s?ej\.|véase|ver|cf\.|citado en)[ \t]*,?[ \t]*)?{CITATION_AUTHORS},?[ \t]+(?P<years>{CITATION_YEARS})")
+BIBLIOGRAPHY_HEADING = re.compile(
+    r"^(?:(#{1,6})\s*|\*\*)(?:\d+[.)]?\s*)?(?:referencias(?: bibliogr[aá]ficas)?|bibliograf[ií]a|references|bibliography|obras citadas|works cited)\b.*$",
+    re.IGNORECASE | re.MULTILINE
+)
+REFERENCE_START = re.compile(r"^(?:[-*•][ \t]+|\d+[.)][ \t]+|\[\d+\][ \t]*)|^(?=\**[A-ZÁÉÍÓÚÑÜ][\w'’-]+(?:[ \t]+[A-ZÁÉÍÓÚÑÜ][\w'’-]+)*,\s)")
+# Entries with no bullet that open with a corporate author ('Organización Mundial de la Salud [OMS]. (2021)')
+REFERENCE_YEAR_START = re.compile(rf"^[^()\n]{{1,150}}?\((?:{CITATION_YEAR})\)")
+# Acronym given for an author before the year, which citations often use instead: '[OMS]' or '(OMS)'
+REFERENCE_ACRONYM = re.compile(r"[\[(]([A-ZÁÉÍÓÚÑÜ]{2,})[\])]")
+REFERENCE_AUTHOR_YEAR = re.compile(rf"(?P<surname>{CITATION_SURNAME})[^\n]*?(?P<year>{CITATION_YEAR})")
+# Which Stage 2 steps each extraction mode does locally; the rest still call their app
+CITATION_EXTRACTION_MODES = {
+    "off": (),
+    "hybrid": ("mapping_referencias",),
+    "local": ("mapping_referencias", "mapping_citas"),
+}
+CITATION_EXTRACTION_LABELS = {
+    "off": "Off (mapping apps only)",
+    "hybrid": "Local bibliography, app citations",
+    "local": "Local bibliography and citations",
+}
+
+# Append-only log of every Wordware and LlamaParse call, one JSON record per line
+METRICS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "metrics", "calls.jsonl")
+METRICS_DASHBOARD_RECORDS = 5000  # most recent records loaded by the dashboard
+
 # --- SESSION STATE MANAGEMENT ---
 
 def initialize_session_state():
@@ -74,177 +236,2588 @@ def initialize_session_state():
         # Stage Status Tracking
         'stage_1_status': 'pending', 'stage_2_status': 'pending', 'stage_3_status': 'pending',
         'stage_4_status': 'pending', 'stage_5_status': 'pending',
-        'stage_2_1_status': 'pending', 'stage_2_2_status': 'pending',
-        'stage_2_3_status': 'pending', 'stage_2_4_status': 'pending',
 
-        # Primary Data Storage
-        'compendio_md': "", 'project_brief_md': "", 'mapping_combined': "",
-        'skeleton': {}, 'generated_chapters': {}, 'final_ebook': "",
+        # Stage 2 runs the mapping apps on compendio sections in parallel instead of the whole text
+        'chunked_mapping': False,
+        # Step 2.4 merges the mappings in-process, calling mapping_logic only if that fails validation
+        'local_mapping_merge': True,
+        # Steps 2.1/2.2 done by the local citation extractor (see CITATION_EXTRACTION_MODES)
+        'citation_extraction': 'off',
+        # Stage 4 sends each chapter only its part of the combined mapping (see MappingStore.chapter_view_json)
+        'chapter_mapping_views': False,
+
+        # Pipeline node status by node name ('completed', 'stale' or 'error'), see pipeline_nodes
+        'pipeline_status': {},
+
+        # Primary Data Storage
+        'compendio_md': "", 'project_brief_md': "", 'mapping_combined': MappingStore(),
+        'skeleton': {}, 'generated_chapters': {}, 'final_ebook': "",
+
+        # User settings for Stage 3
+        'topic_input': "", 'reference_count': 25, 'page_count': "40-50", 'subtemas_enabled': False,
+
+        # File management
+        'uploaded_files': {},
+
+        # Intermediate outputs for modular recovery
+        'stage_1_1_output': "", 'stage_1_2_output': "",
+        'mapping_referencias': MappingStore(), 'mapping_citas': MappingStore(), 'mapping_tablas': MappingStore(),
+
+        # Text salvaged from Wordware streams that failed mid-run, by app name
+        'partial_outputs': {},
+
+        # Wordware/LlamaParse jobs this session is waiting on, by job id; cancelled if the run is abandoned
+        'active_jobs': {},
+
+        # Stage 1 parse engine per document ('local' drafts are replaced by background LlamaParse jobs)
+        'document_sources': {}, 'background_parses': {},
+
+        # What normalization removed from each parsed document, and how to map its offsets back to the raw text
+        'document_normalization': {}, 'compendio_raw_md': "", 'project_brief_raw_md': "",
+
+        # Sequential Chapter Generation Management
+        'chapter_sequence': [], 'current_chapter_index': 0, 'previous_context': "",
+        'chapters_completed': [], 'book_complete': False
+    }
+
+    for key, value in defaults.items():
+        if key not in st.session_state:
+            st.session_state[key] = value
+
+def clear_all_session_data():
+    """Resets the entire pipeline by clearing relevant session state keys."""
+    cancel_session_jobs("cleared")
+    cancel_background_parses("cleared")
+    keys_to_clear = [key for key in st.session_state.keys() if key.startswith((
+        'stage_', 'compendio_', 'project_', 'mapping_', 'skeleton', 'generated_', 
+        'final_', 'topic_', 'reference_', 'page_', 'subtemas_', 'uploaded_', 
+        'chapter_', 'current_', 'previous_', 'book_', 'partial_', 'document_', 'background_', 'pipeline_', 'citation_index'))]
+    
+    for key in keys_to_clear:
+        del st.session_state[key]
+    
+    st.success("All pipeline data has been cleared. Please refresh the page to start over.")
+    time.sleep(2)
+    st.rerun()
+
+# --- FILE UPLOAD HELPERS ---
+
+def spool_upload(file):
+    """
+    Copies an uploaded file to a temp file in UPLOAD_SPOOL_CHUNK slices of Streamlit's own buffer,
+    hashing it in the same pass, so no full-size copy of the bytes is ever made in memory.
+    The caller holds the first reference; parse jobs retain their own, and release_spooled_upload deletes
+    the file once the last one lets go.
+    """
+    digest = hashlib.sha256()
+    with file.getbuffer() as buffer, tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
+        for start in range(0, len(buffer), UPLOAD_SPOOL_CHUNK):
+            chunk = buffer[start:start + UPLOAD_SPOOL_CHUNK]
+            digest.update(chunk)
+            tmp_file.write(chunk)
+        size = len(buffer)
+    return {"name": file.name, "type": file.type, "path": tmp_file.name, "size": size, "sha256": digest.hexdigest(), "refs": 1}
+
+def retain_spooled_upload(spool):
+    with get_inflight_calls()["lock"]:
+        spool["refs"] += 1
+
+def release_spooled_upload(spool):
+    with get_inflight_calls()["lock"]:
+        spool["refs"] -= 1
+        if spool["refs"] > 0:
+            return
+    try:
+        os.unlink(spool["path"])
+    except OSError:
+        pass
+
+@contextlib.contextmanager
+def upload_payload(file):
+    """Yields (name, file object, content type) for a multipart upload of an UploadedFile or a spooled upload."""
+    if isinstance(file, dict):
+        with open(file["path"], 'rb') as f:
+            yield (file["name"], f, file["type"])
+    else:
+        file.seek(0)
+        yield (file.name, file, file.type)
+
+async def upload_to_0x0(client, file):
+    """Uploads a file to 0x0.st."""
+    with upload_payload(file) as payload:
+        files = {"file": payload}
+        # httpx streams file objects in chunks instead of building the whole body in memory
+        response = await client.post("https://0x0.st", files=files)
+    if response.status_code == 200 and response.text.strip().startswith("https://"):
+        return response.text.strip()
+    return None
+
+async def upload_to_catbox(client, file):
+    """Uploads a file to catbox.moe."""
+    with upload_payload(file) as payload:
+        files = {"fileToUpload": payload}
+        data = {"reqtype": "fileupload"}
+        response = await client.post("https://catbox.moe/user/api.php", files=files, data=data)
+    if response.status_code == 200 and response.text.strip().startswith("https://"):
+        return response.text.strip()
+    return None
+
+async def upload_to_tmpfiles(client, file):
+    """Uploads a file to tmpfiles.org."""
+    with upload_payload(file) as payload:
+        files = {"file": payload}
+        response = await client.post("https://tmpfiles.org/api/v1/upload", files=files)
+    if response.status_code == 200:
+        data = response.json()
+        url = data.get("data", {}).get("url", "")
+        if url:
+            return url.replace("https://tmpfiles.org/", "https://tmpfiles.org/dl/")
+    return None
+
+async def upload_to_fileio(client, file):
+    """Uploads a file to file.io."""
+    with upload_payload(file) as payload:
+        files = {"file": payload}
+        response = await client.post("https://file.io", files=files)
+    if response.status_code == 200:
+        data = response.json()
+        return data.get("link", "")
+    return None
+
+# Upload services: name -> (upload function, seconds its URLs stay valid). Each function returns a
+# public URL, or None / raises if the upload failed. file.io deletes a file after its first download,
+# so its URLs are never reused
+UPLOAD_SERVICES = {
+    "0x0.st": (upload_to_0x0, 30 * 24 * 3600),
+    "catbox.moe": (upload_to_catbox, 365 * 24 * 3600),
+    "tmpfiles.org": (upload_to_tmpfiles, 3600),
+    "file.io": (upload_to_fileio, 0),
+}
+
+@st.cache_resource
+def get_upload_stats():
+    """Process-wide record of recent upload attempts per service: deques of (succeeded, seconds)."""
+    return {"lock": threading.Lock(), "services": collections.defaultdict(lambda: collections.deque(maxlen=UPLOAD_STATS_WINDOW))}
+
+def record_upload_attempt(service, succeeded, seconds):
+    stats = get_upload_stats()
+    with stats["lock"]:
+        stats["services"][service].append((succeeded, seconds))
+
+def rank_upload_services():
+    """
+    Service names, most reliable first: by recent success rate (smoothed, so an untried service sits
+    between good and bad ones), then by average upload time.
+    """
+    stats = get_upload_stats()
+    with stats["lock"]:
+        history = {name: list(stats["services"][name]) for name in UPLOAD_SERVICES}
+
+    def score(name):
+        attempts = history[name]
+        successes = [seconds for succeeded, seconds in attempts if succeeded]
+        success_rate = (len(successes) + 1) / (len(attempts) + 2)
+        latency = sum(successes) / len(successes) if successes else float('inf')
+        return (-success_rate, latency)
+
+    return sorted(UPLOAD_SERVICES, key=score)
+
+def cached_upload_url(sha256):
+    """Returns the cached {"url", "service", "expires"} for a file, if its URL is still valid for a while."""
+    entry = disk_cache_get(UPLOAD_URL_CACHE_DIR, sha256, max(ttl for _, ttl in UPLOAD_SERVICES.values()))
+    if entry and entry["expires"] - time.time() > UPLOAD_URL_MIN_REMAINING:
+        return entry
+    return None
+
+async def race_uploads(pdf):
+    """
+    Returns {"url", "service", "expires"} for a public copy of a spooled upload, uploading it only if no
+    cached URL for the same SHA-256 is still valid.
+    Services are started in rank_upload_services order, each UPLOAD_RACE_STAGGER seconds after the last
+    unless one has already failed; the first valid URL wins and the other uploads are cancelled.
+    Raises RuntimeError listing why each service failed.
+    """
+    cached = await asyncio.to_thread(cached_upload_url, pdf["sha256"])
+    if cached:
+        return dict(cached, cached=True)
+
+    waiting = rank_upload_services()
+    running = {}
+    errors = []
+    winner = None
+    async with httpx.AsyncClient(timeout=httpx.Timeout(UPLOAD_TIMEOUT, connect=15), follow_redirects=True) as client:
+
+        async def attempt(name):
+            start = time.time()
+            try:
+                url = await UPLOAD_SERVICES[name][0](client, pdf)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                record_upload_attempt(name, False, time.time() - start)
+                raise RuntimeError(f"{name}: {str(e) or type(e).__name__}")
+            if not url or not url.startswith("https://"):
+                record_upload_attempt(name, False, time.time() - start)
+                raise RuntimeError(f"{name}: no URL returned")
+            record_upload_attempt(name, True, time.time() - start)
+            return url
+
+        try:
+            while (waiting or running) and winner is None:
+                if waiting:
+                    name = waiting.pop(0)
+                    running[asyncio.ensure_future(attempt(name))] = name
+                done, _ = await asyncio.wait(running, timeout=UPLOAD_RACE_STAGGER if waiting else None, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = running.pop(task)
+                    if task.exception() is not None:
+                        errors.append(str(task.exception()))
+                    elif winner is None:
+                        winner = (name, task.result())
+        finally:
+            for task in running:
+                task.cancel()
+
+    if winner is None:
+        raise RuntimeError(f"All file upload services failed ({'; '.join(errors)})")
+    name, url = winner
+    ttl = UPLOAD_SERVICES[name][1]
+    entry = {"url": url, "service": name, "expires": time.time() + ttl}
+    if ttl:
+        await asyncio.to_thread(disk_cache_put, UPLOAD_URL_CACHE_DIR, pdf["sha256"], entry, UPLOAD_URL_CACHE_MAX_BYTES)
+    return dict(entry, cached=False)
+
+def upload_file_with_fallback(file):
+    """
+    Gets a public URL for an uploaded or spooled file by racing the upload services (see race_uploads).
+    Returns None after showing an error if every service failed.
+    """
+    pdf = file if isinstance(file, dict) else spool_upload(file)
+    try:
+        with st.spinner("Uploading file..."):
+            future = asyncio.run_coroutine_threadsafe(race_uploads(pdf), get_event_loop())
+            upload = future.result()
+    except Exception as e:
+        st.error(f"All file upload services failed. Please check your network or try again later. {e}")
+        return None
+    finally:
+        if pdf is not file:
+            release_spooled_upload(pdf)
+    if upload["cached"]:
+        st.toast(f"Reusing the earlier upload to {upload['service']}", icon="♻️")
+    else:
+        st.toast(f"Successfully uploaded via {upload['service']}!", icon="✅")
+    return upload["url"]
+
+def hosted_input(file_name, text, file_type="text/markdown"):
+    """
+    With 'Host large inputs' on, returns a Wordware file input pointing at a hosted copy of text instead of
+    the text itself, for inputs of at least HOSTED_INPUT_MIN_BYTES that every call would otherwise re-send.
+    The copy is uploaded once per content hash and uploaded again when the text changes or the copy is
+    about to expire. Falls back to the inline text if hosting fails.
+    """
+    if not st.session_state.get('host_large_inputs', False):
+        return text
+    data = text.encode('utf-8')
+    if len(data) < HOSTED_INPUT_MIN_BYTES:
+        return text
+    sha256 = hashlib.sha256(data).hexdigest()
+    hosted = st.session_state.uploaded_files.get(file_name)
+    if not hosted or hosted["sha256"] != sha256 or hosted["expires"] - time.time() < UPLOAD_URL_MIN_REMAINING:
+        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file_name)[1]) as tmp_file:
+            tmp_file.write(data)
+        artifact = {"name": file_name, "type": file_type, "path": tmp_file.name, "size": len(data), "sha256": sha256, "refs": 1}
+        try:
+            with st.spinner(f"Hosting {file_name} ({len(data) / (1024 * 1024):.1f} MB)..."):
+                upload = asyncio.run_coroutine_threadsafe(race_uploads(artifact), get_event_loop()).result()
+        except Exception as e:
+            st.toast(f"Could not host {file_name}, sending it inline: {e}", icon="⚠️")
+            return text
+        finally:
+            release_spooled_upload(artifact)
+        hosted = {"url": upload["url"], "service": upload["service"], "expires": upload["expires"], "sha256": sha256, "size": len(data)}
+        st.session_state.uploaded_files[file_name] = hosted
+    return {"type": "file", "file_type": file_type, "file_url": hosted["url"], "file_name": file_name}
+
+# --- HTTP CLIENT ---
+
+@st.cache_resource
+def get_event_loop():
+    """
+    Starts the process-wide asyncio loop that runs every Wordware stream.
+    Running it in its own thread lets many calls stream concurrently without blocking the script thread.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="wordware-event-loop", daemon=True).start()
+    return loop
+
+@st.cache_resource
+def get_http_client():
+    """
+    Returns the process-wide async HTTP client used for Wordware calls.
+    Cached as a resource so keep-alive connections survive reruns and are shared across sessions.
+    """
+    client = httpx.AsyncClient(
+        headers={"Authorization": f"Bearer {API_KEY}"},
+        # Concurrency is left to the per-app schedulers; a connection cap here would queue calls out of their sight
+        limits=httpx.Limits(max_connections=None, max_keepalive_connections=HTTP_POOL_SIZE),
+        timeout=httpx.Timeout(WORDWARE_TIMEOUT, connect=30)
+    )
+    stats = {"hits": 0, "misses": 0, "hit_latency": 0.0, "miss_latency": 0.0}
+    return {"client": client, "stats": stats, "lock": threading.Lock()}
+
+def record_pool_usage(http, reused, latency):
+    """Counts a request as a pool hit (reused connection) or miss (new connection)."""
+    with http["lock"]:
+        if reused:
+            http["stats"]["hits"] += 1
+            http["stats"]["hit_latency"] += latency
+        else:
+            http["stats"]["misses"] += 1
+            http["stats"]["miss_latency"] += latency
+
+class WordwareScheduler:
+    """
+    Concurrency limit plus token bucket for one Wordware app, shared by every session.
+    Waiting calls are served by weighted fair queuing: each session's virtual time advances by
+    1/weight per call, and the waiter with the smallest finish tag goes next. Interactive calls
+    have a higher weight, so they jump ahead of bulk work without starving it.
+    All methods except snapshot() run on the shared event loop.
+    """
+
+    def __init__(self, concurrency, rate_per_minute, burst):
+        self.concurrency = concurrency
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.tokens = burst
+        self.refilled_at = time.monotonic()
+        self.running = 0
+        self.waiters = []
+        self.virtual_times = {}
+        self.clock = 0.0
+        self.timer = None
+        self.waits = collections.deque(maxlen=50)
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+    def dispatch(self):
+        """Grants slots to waiters while both a concurrency slot and a token are available."""
+        with self.lock:
+            while self.waiters and self.running < self.concurrency:
+                self.refill()
+                if self.tokens < 1:
+                    if self.timer is None:
+                        self.timer = asyncio.get_running_loop().call_later((1 - self.tokens) / self.rate, self.on_timer)
+                    return
+                # Waiters cancelled since the last dispatch are dropped rather than granted a slot
+                self.waiters = [w for w in self.waiters if not w["future"].done()]
+                if not self.waiters:
+                    return
+                waiter = min(self.waiters, key=lambda w: (w["finish"], w["enqueued"]))
+                self.waiters.remove(waiter)
+                self.tokens -= 1
+                self.running += 1
+                self.clock = waiter["finish"]
+                waiter["granted"] = True
+                waiter["future"].set_result(None)
+
+    def on_timer(self):
+        self.timer = None
+        self.dispatch()
+
+    async def acquire(self, session_id, priority, emit):
+        """Waits for a slot; returns the seconds spent queued."""
+        with self.lock:
+            start = max(self.virtual_times.get(session_id, 0.0), self.clock)
+            waiter = {
+                "session": session_id,
+                "finish": start + 1 / PRIORITY_WEIGHTS.get(priority, 1.0),
+                "enqueued": time.time(),
+                "future": asyncio.get_running_loop().create_future(),
+                "granted": False
+            }
+            self.waiters.append(waiter)
+            # The session's next call queues behind this one, so a burst of calls doesn't share one tag
+            self.virtual_times[session_id] = waiter["finish"]
+        self.dispatch()
+        if not waiter["future"].done():
+            emit('queued', {"depth": len(self.waiters), "running": self.running})
+        try:
+            await waiter["future"]
+        except asyncio.CancelledError:
+            with self.lock:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+                granted = waiter["granted"]
+            if granted:
+                self.release()
+            raise
+        wait = time.time() - waiter["enqueued"]
+        self.waits.append(wait)
+        return wait
+
+    def release(self):
+        with self.lock:
+            self.running -= 1
+        self.dispatch()
+
+    def snapshot(self):
+        """Queue depth, running calls and recent wait times for the UI."""
+        with self.lock:
+            waits = list(self.waits)
+            return {
+                "queued": len(self.waiters),
+                "running": self.running,
+                "concurrency": self.concurrency,
+                "avg_wait": sum(waits) / len(waits) if waits else 0.0,
+                "max_wait": max(waits) if waits else 0.0,
+                "oldest_wait": max((time.time() - w["enqueued"] for w in self.waiters), default=0.0)
+            }
+
+@st.cache_resource
+def get_wordware_schedulers():
+    """One scheduler per Wordware app, shared by every session."""
+    schedulers = {}
+    for name, app_id in APP_IDS.items():
+        limits = dict(WORDWARE_DEFAULT_LIMITS, **WORDWARE_APP_LIMITS.get(name, {}))
+        schedulers[app_id] = WordwareScheduler(**limits)
+    return schedulers
+
+def get_wordware_scheduler(app_id):
+    """Returns the app's scheduler, creating one with default limits for unknown app ids."""
+    schedulers = get_wordware_schedulers()
+    if app_id not in schedulers:
+        schedulers[app_id] = WordwareScheduler(**WORDWARE_DEFAULT_LIMITS)
+    return schedulers[app_id]
+
+def get_session_id():
+    """Identifies the browser session a call comes from, for fair scheduling."""
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else "default"
+
+def get_pool_stats():
+    """Returns pool hit/miss counts and the average time-to-headers for each."""
+    http = get_http_client()
+    with http["lock"]:
+        stats = dict(http["stats"])
+    stats["avg_hit_latency"] = stats["hit_latency"] / stats["hits"] if stats["hits"] else 0.0
+    stats["avg_miss_latency"] = stats["miss_latency"] / stats["misses"] if stats["misses"] else 0.0
+    return stats
+
+# --- RESPONSE CACHE ---
+
+def wordware_request_key(app_id, inputs):
+    """
+    Returns a content hash identifying an app run by its app_id and canonicalized inputs.
+    Runs against any endpoint other than Wordware's (e.g. a stand-in) also hash API_BASE_URL, so their outputs
+    are never served as real results once it's switched back.
+    """
+    request = {"app_id": app_id, "inputs": inputs}
+    if API_BASE_URL.rstrip("/") != WORDWARE_API_BASE_URL:
+        request["base_url"] = API_BASE_URL.rstrip("/")
+    canonical = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def parse_cache_key(pdf_hash, parsing_instruction, result_type, pages=None):
+    """
+    Returns a content hash identifying a parse by the PDF's SHA-256, the instruction and the result type.
+    pages=(first, last) identifies one shard of a page-sharded parse.
+    """
+    key = {"pdf_sha256": pdf_hash, "instruction": parsing_instruction, "result_type": result_type}
+    if pages is not None:
+        key["pages"] = list(pages)
+    canonical = json.dumps(key, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def disk_cache_get(cache_dir, key, ttl):
+    """Returns a cached entry, or None if it is missing or older than ttl seconds."""
+    path = os.path.join(cache_dir, f"{key}.json")
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if time.time() - entry.get('created', 0) > ttl:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        return None
+    # The file's mtime doubles as its last-access time for LRU eviction
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return entry
+
+def disk_cache_put(cache_dir, key, entry, max_bytes):
+    """Stores an entry atomically, then evicts least recently used entries above max_bytes."""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"{key}.json")
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    entry = dict(entry, created=time.time())
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except (OSError, TypeError, ValueError):
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        return
+    evict_disk_cache(cache_dir, max_bytes)
+
+def list_disk_cache(cache_dir):
+    """Returns (path, size, last_access) for every entry, oldest first."""
+    entries = []
+    if not os.path.isdir(cache_dir):
+        return entries
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            info = os.stat(path)
+        except OSError:
+            continue
+        entries.append((path, info.st_size, info.st_mtime))
+    return sorted(entries, key=lambda entry: entry[2])
+
+def evict_disk_cache(cache_dir, max_bytes):
+    """Deletes least recently used entries until the cache fits in max_bytes."""
+    entries = list_disk_cache(cache_dir)
+    total = sum(size for _, size, _ in entries)
+    for path, size, _ in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+            total -= size
+        except OSError:
+            pass
+
+def clear_disk_cache(cache_dir):
+    """Deletes every entry in the cache directory."""
+    for path, _, _ in list_disk_cache(cache_dir):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+def is_wordware_cache_enabled(app_id):
+    """Checks the session's cache settings for the given app."""
+    if not st.session_state.get('cache_enabled', True):
+        return False
+    bypass_apps = st.session_state.get('cache_bypass_apps', WORDWARE_CACHE_BYPASS_APPS)
+    return APP_NAMES.get(app_id, app_id) not in bypass_apps
+
+def replay_cached_chunks(chunks, chunks_per_second):
+    """Yields a stored chunk stream, paced at chunks_per_second (0 yields it all at once)."""
+    if not chunks_per_second:
+        yield "".join(chunks)
+        return
+    delay = 1 / chunks_per_second
+    for chunk in chunks:
+        yield chunk
+        time.sleep(delay)
+
+# --- METRICS ---
+
+@st.cache_resource
+def get_metrics_lock():
+    """Serializes appends to METRICS_FILE across sessions and the event loop thread."""
+    return threading.Lock()
+
+def new_call_metrics(kind, app, request_bytes):
+    """Starts a metrics record for one Wordware or LlamaParse call."""
+    return {
+        "kind": kind, "app": app, "request_bytes": request_bytes, "start": time.time(),
+        "ttfb": None, "duration": None, "chunks": 0, "output_bytes": 0, "attempts": 0, "outcome": "error"
+    }
+
+def record_call_metrics(metrics):
+    """Finishes a metrics record and appends it to METRICS_FILE; metrics must never break a call."""
+    metrics["duration"] = time.time() - metrics["start"]
+    try:
+        os.makedirs(os.path.dirname(METRICS_FILE), exist_ok=True)
+        with get_metrics_lock():
+            with open(METRICS_FILE, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(metrics, ensure_ascii=False) + "\n")
+    except OSError:
+        pass
+
+def load_call_metrics(limit=METRICS_DASHBOARD_RECORDS):
+    """Returns the most recent metrics records, oldest first."""
+    try:
+        with open(METRICS_FILE, 'r', encoding='utf-8') as f:
+            lines = collections.deque(f, maxlen=limit)
+    except OSError:
+        return []
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return records
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers (0 for an empty list)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+# --- API CALLER & STREAMING ---
+
+def extract_final_output(final_output):
+    """Picks the main value out of a Wordware 'outputs' record."""
+    if final_output:
+        # Assuming the main output is in a key named 'output', 'text', or the first value
+        output_data = final_output.get('values', {})
+        if 'output' in output_data:
+            return output_data['output']
+        elif 'text' in output_data:
+            return output_data['text']
+        # Fallback for varied output structures
+        elif output_data:
+            # first_key = next(iter(output_data))
+            # return output_data[first_key]
+            return output_data
+    return None
+
+class WordwareStreamStalled(httpx.ReadTimeout):
+    """Raised when a run stops sending NDJSON lines for longer than its stall timeout (see WORDWARE_STALL_TIMEOUT)."""
+
+def is_retryable_error(error):
+    """Transient network errors, stalls and 429/5xx responses are worth another attempt."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in WORDWARE_RETRY_STATUS_CODES
+    return isinstance(error, httpx.TransportError)
+
+def retry_delay(attempt, error):
+    """Exponential backoff with full jitter, honoring a numeric Retry-After header when the server sends one."""
+    if isinstance(error, httpx.HTTPStatusError):
+        retry_after = error.response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(int(retry_after), WORDWARE_BACKOFF_MAX)
+    return random.uniform(0, min(WORDWARE_BACKOFF_MAX, WORDWARE_BACKOFF_BASE * 2 ** attempt))
+
+async def stream_wordware_attempt(url, inputs, emit, chunks, stall_timeout=WORDWARE_STALL_TIMEOUT):
+    """
+    Makes one streaming request and returns the 'outputs' record, appending chunks as they arrive.
+    Raises WordwareStreamStalled if no line arrives for stall_timeout seconds.
+    """
+    http = get_http_client()
+    new_connection = False
+
+    async def trace(event_name, info):
+        nonlocal new_connection
+        if event_name.startswith("connection.connect_tcp"):
+            new_connection = True
+
+    start_time = time.time()
+    async with http["client"].stream("POST", url, json={"inputs": inputs}, extensions={"trace": trace}) as response:
+        record_pool_usage(http, not new_connection, time.time() - start_time)
+        if response.is_error:
+            # Read the body so the error details are available to the caller
+            await response.aread()
+            response.raise_for_status()
+
+        final_output = None
+        lines = response.aiter_lines()
+        while True:
+            # Stall watchdog: a silent stream is dropped and retried instead of waiting for the full timeout
+            try:
+                line = await asyncio.wait_for(lines.__anext__(), stall_timeout)
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                raise WordwareStreamStalled(f"No data received for {stall_timeout:.0f}s")
+            if not line:
+                continue
+            try:
+                content = json.loads(line)
+            except json.JSONDecodeError:
+                emit('warning', f"Could not decode JSON line: {line}")
+                continue
+            value = content.get('value', {})
+            if value.get('type') == 'chunk':
+                chunks.append(value.get('value', ''))
+                emit('chunk', value.get('value', ''))
+            elif value.get('type') == 'outputs':
+                final_output = value
+        return final_output
+
+async def run_wordware_app(app_id, inputs, emit=None, use_cache=True, session_id="default", priority="interactive"):
+    """
+    Runs a Wordware app on the current event loop and returns its final output.
+    emit(kind, payload) receives ('chunk', text), ('cached', chunks), ('queued', info), ('started', info),
+    ('retry', info) and ('warning', message) events as they happen.
+    Each attempt waits for the app's scheduler, which shares the API key fairly across sessions.
+    Transient failures are retried with backoff; raises httpx.HTTPError once retries are exhausted.
+    """
+    notify = emit or (lambda kind, payload: None)
+    metrics = new_call_metrics("wordware", APP_NAMES.get(app_id, app_id), len(json.dumps({"inputs": inputs}).encode('utf-8')))
+
+    def emit(kind, payload):
+        if kind == 'chunk':
+            if metrics["ttfb"] is None:
+                metrics["ttfb"] = time.time() - metrics["start"]
+            metrics["chunks"] += 1
+            metrics["output_bytes"] += len(payload.encode('utf-8'))
+        notify(kind, payload)
+
+    try:
+        cache_key = None
+        if use_cache:
+            cache_key = wordware_request_key(app_id, inputs)
+            cached = await asyncio.to_thread(disk_cache_get, WORDWARE_CACHE_DIR, cache_key, WORDWARE_CACHE_TTL)
+            if cached is not None:
+                metrics["ttfb"] = time.time() - metrics["start"]
+                metrics["chunks"] = len(cached.get('chunks', []))
+                metrics["output_bytes"] = sum(len(chunk.encode('utf-8')) for chunk in cached.get('chunks', []))
+                metrics["outcome"] = "cached"
+                notify('cached', cached.get('chunks', []))
+                return cached['output']
+
+        url = f"{API_BASE_URL}/{app_id}/run"
+        stall_timeout = WORDWARE_APP_STALL_TIMEOUTS.get(APP_NAMES.get(app_id, app_id), WORDWARE_STALL_TIMEOUT)
+        scheduler = get_wordware_scheduler(app_id)
+        attempt = 0
+        while True:
+            chunks = []
+            wait = await scheduler.acquire(session_id, priority, emit)
+            metrics["attempts"] += 1
+            metrics["queue_wait"] = metrics.get("queue_wait", 0.0) + wait
+            emit('started', {"wait": wait})
+            try:
+                final_output = await stream_wordware_attempt(url, inputs, emit, chunks, stall_timeout)
+                break
+            except httpx.HTTPError as e:
+                if attempt >= WORDWARE_MAX_RETRIES or not is_retryable_error(e):
+                    if chunks:
+                        emit('partial', "".join(chunks))
+                    metrics["error"] = str(e) or type(e).__name__
+                    raise
+                delay = retry_delay(attempt, e)
+                attempt += 1
+                # The run can't be resumed server-side, so hand the partial text to the UI before starting over
+                emit('retry', {"attempt": attempt, "delay": delay, "reason": str(e) or type(e).__name__, "partial": "".join(chunks)})
+            finally:
+                # The slot is given back after every attempt, so backing off doesn't hold it
+                scheduler.release()
+            await asyncio.sleep(delay)
+
+        result = extract_final_output(final_output)
+        metrics["outcome"] = "ok" if result is not None else "empty"
+        if result is not None and cache_key:
+            await asyncio.to_thread(disk_cache_put, WORDWARE_CACHE_DIR, cache_key, {"app_id": app_id, "output": result, "chunks": chunks}, WORDWARE_CACHE_MAX_BYTES)
+        return result
+    except asyncio.CancelledError as e:
+        # cancel_job passes 'cancelled', 'abandoned' or 'cleared' as the message
+        metrics["outcome"] = e.args[0] if e.args else "cancelled"
+        raise
+    finally:
+        # A single short append; done inline so it also runs when the task is cancelled
+        record_call_metrics(metrics)
+
+@st.cache_resource
+def get_inflight_calls():
+    """Process-wide registry of running Wordware calls, keyed by wordware_request_key."""
+    return {"lock": threading.Lock(), "calls": {}}
+
+def submit_wordware_call(app_id, inputs, use_cache=True, semaphore=None, single_flight=True, priority="interactive"):
+    """
+    Schedules a Wordware run on the shared event loop and returns immediately.
+    priority is 'interactive' for calls a user is waiting on, or 'bulk' for batch generation.
+    The returned job's 'events' queue receives the emitted events followed by None when the run ends.
+    With single_flight, an identical call that is already running (from any session) is joined
+    instead: the new job replays the chunks so far, then follows the live stream.
+    """
+    inflight = get_inflight_calls()
+    key = wordware_request_key(app_id, inputs)
+    session_id = get_session_id()
+    events = queue.Queue()
+
+    with inflight["lock"]:
+        call = inflight["calls"].get(key) if single_flight else None
+        if call is not None:
+            events.put(('joined', None))
+            for event in call["log"]:
+                events.put(event)
+            call["listeners"].append(events)
+            job = {"id": f"job_{id(events)}", "app_id": app_id, "events": events, "future": call["future"], "call": call, "shared": True}
+            register_session_job(job)
+            return job
+
+        call = {"log": [], "listeners": [events], "future": None, "task": None}
+        if single_flight:
+            inflight["calls"][key] = call
+
+    def emit(kind, payload):
+        with inflight["lock"]:
+            call["log"].append((kind, payload))
+            for listener in call["listeners"]:
+                listener.put((kind, payload))
+
+    async def run():
+        with inflight["lock"]:
+            call["task"] = asyncio.current_task()
+        try:
+            if semaphore is None:
+                return await run_wordware_app(app_id, inputs, emit, use_cache, session_id, priority)
+            async with semaphore:
+                return await run_wordware_app(app_id, inputs, emit, use_cache, session_id, priority)
+        finally:
+            with inflight["lock"]:
+                if inflight["calls"].get(key) is call:
+                    del inflight["calls"][key]
+                for listener in call["listeners"]:
+                    listener.put(None)
+
+    with inflight["lock"]:
+        call["future"] = asyncio.run_coroutine_threadsafe(run(), get_event_loop())
+    job = {"id": f"job_{id(events)}", "app_id": app_id, "events": events, "future": call["future"], "call": call, "shared": False}
+    register_session_job(job)
+    return job
+
+def job_result(job):
+    """Returns a job's final output; joined jobs get their own copy so sessions never share mutable state."""
+    result = job["future"].result()
+    return copy.deepcopy(result) if job.get("shared") else result
+
+def register_session_job(job):
+    """Tracks a job the current script run is waiting on, so it can be cancelled if the run is abandoned."""
+    st.session_state.setdefault('active_jobs', {})[job["id"]] = job
+
+def finish_session_job(job):
+    st.session_state.get('active_jobs', {}).pop(job["id"], None)
+
+def cancel_job(job, reason="cancelled"):
+    """
+    Stops listening to a job. The run itself is cancelled once no session listens to it any more,
+    which closes its HTTP stream and frees its scheduler slot right away.
+    """
+    call = job["call"]
+    with get_inflight_calls()["lock"]:
+        if job["events"] in call["listeners"]:
+            call["listeners"].remove(job["events"])
+        job["cancelled"] = reason
+        job["events"].put(None)
+        orphaned = not call["listeners"]
+        task = call["task"]
+    if not orphaned or job["future"].done():
+        return
+    if task is not None:
+        get_event_loop().call_soon_threadsafe(task.cancel, reason)
+    else:
+        # Not started yet
+        job["future"].cancel()
+
+def cancel_session_job(job):
+    """on_click handler for a job's cancel button."""
+    finish_session_job(job)
+    cancel_job(job)
+    st.toast(f"⏹ Cancelled {APP_NAMES.get(job['app_id'], job['app_id'])}.")
+
+def cancel_session_jobs(reason="abandoned"):
+    """
+    Cancels the jobs this session stopped waiting for. A widget click or navigation stops the running
+    script mid-stream, so any job still registered at the start of the next run has been abandoned.
+    """
+    jobs = st.session_state.get('active_jobs', {})
+    if not jobs:
+        return
+    for job in list(jobs.values()):
+        cancel_job(job, reason)
+    jobs.clear()
+    # Stages left 'in_progress' by the interrupted run would otherwise stay locked
+    for key in [key for key in st.session_state.keys() if key.startswith('stage_') and key.endswith('_status')]:
+        if st.session_state[key] == 'in_progress':
+            st.session_state[key] = 'pending'
+
+def render_cancel_button(job, label=None):
+    """Shows a cancel button for a running job; returns the placeholder so it can be cleared afterwards."""
+    slot = st.empty()
+    slot.button(
+        label or f"⏹ Cancel {APP_NAMES.get(job['app_id'], job['app_id'])}",
+        key=f"cancel_{job['id']}",
+        on_click=cancel_session_job,
+        args=(job,)
+    )
+    return slot
+
+def heartbeat(placeholder, stats, interval=1.0):
+    """
+    Returns an idle callback that refreshes a progress caption at most once per interval.
+    Streamlit only stops a script (e.g. for a cancel click) when it writes an element, so quiet waits need it.
+    """
+    last = {"time": 0.0}
+
+    def beat():
+        if time.time() - last["time"] >= interval:
+            placeholder.caption(format_stream_progress(stats))
+            last["time"] = time.time()
+    return beat
+
+def save_partial_output(job, text):
+    """Keeps the text streamed before a failure so it survives the retry or the error."""
+    if not text:
+        return
+    job["partial"] = text
+    app_name = APP_NAMES.get(job['app_id'], job['app_id'])
+    st.session_state.partial_outputs[app_name] = {"text": text, "time": time.time()}
+
+def report_retry(job, info):
+    """Tells the user a stream is being retried."""
+    save_partial_output(job, info["partial"])
+    st.toast(f"🔁 {info['reason']} — retrying in {info['delay']:.0f}s (attempt {info['attempt']}/{WORDWARE_MAX_RETRIES})", icon="⚠️")
+
+def report_wordware_error(error, partial=None):
+    """Shows a failed Wordware call in the UI, along with any output received before it failed."""
+    st.error(f"API Request Failed: {error}")
+    response = getattr(error, 'response', None) if isinstance(error, httpx.HTTPStatusError) else None
+    if response is not None:
+        try:
+            st.error(f"Error details: {response.json()}")
+        except:
+            st.error(f"Error details: {response.text}")
+    if partial:
+        with st.expander(f"Partial output received before the failure ({len(partial)} characters)"):
+            st.markdown(partial)
+
+def new_render_stats(job):
+    """Starts the per-call counters used to measure stream throughput and UI cost."""
+    return {"app": APP_NAMES.get(job['app_id'], job['app_id']), "start": time.time(), "chunks": 0, "bytes": 0, "flushes": 0, "render_time": 0.0}
+
+def job_event_text(job, event, stats, replay_speed=0):
+    """Handles one job event and returns the text pieces it contributes to the stream."""
+    kind, payload = event
+    if kind == 'chunk':
+        stats["chunks"] += 1
+        stats["bytes"] += len(payload.encode('utf-8'))
+        return [payload]
+    elif kind == 'cached':
+        st.toast(f"Loaded {APP_NAMES.get(job['app_id'], job['app_id'])} result from cache.", icon="⚡")
+        stats["chunks"] += len(payload)
+        stats["bytes"] += sum(len(chunk.encode('utf-8')) for chunk in payload)
+        return replay_cached_chunks(payload, replay_speed)
+    elif kind == 'retry':
+        report_retry(job, payload)
+        # Earlier text stays on screen; the new attempt streams below it
+        return ["\n\n---\n\n*🔁 Reintentando...*\n\n"]
+    elif kind == 'queued':
+        stats["queued"] = True
+        st.toast(f"⏳ {APP_NAMES.get(job['app_id'], job['app_id'])} queued behind {payload['running']} running call(s) ({payload['depth']} waiting)", icon="🚦")
+    elif kind == 'started':
+        stats["queue_wait"] = stats.get("queue_wait", 0.0) + payload["wait"]
+    elif kind == 'joined':
+        st.toast(f"Joined an identical {APP_NAMES.get(job['app_id'], job['app_id'])} request that was already running.", icon="🔗")
+    elif kind == 'partial':
+        save_partial_output(job, payload)
+    elif kind == 'warning':
+        st.warning(payload)
+    return []
+
+def job_text_pieces(job, stats, replay_speed=0, on_idle=None):
+    """Yields a job's text as it arrives, and "" whenever it is idle so callers can flush on time."""
+    while True:
+        try:
+            event = job["events"].get(timeout=STREAM_FLUSH_INTERVAL)
+        except queue.Empty:
+            if on_idle:
+                on_idle()
+            yield ""
+            continue
+        if event is None:
+            return
+        yield from job_event_text(job, event, stats, replay_speed)
+
+def coalesce_text(pieces, stats):
+    """
+    Buffers text pieces and yields them in batches, flushing every STREAM_FLUSH_INTERVAL seconds
+    or STREAM_FLUSH_BYTES bytes, so the browser gets a handful of deltas instead of one per token.
+    The time the consumer spends between yields is counted as render overhead.
+    """
+    buffer = []
+    buffered_bytes = 0
+    last_flush = time.time()
+    for piece in pieces:
+        if piece:
+            buffer.append(piece)
+            buffered_bytes += len(piece.encode('utf-8'))
+        if buffer and (buffered_bytes >= STREAM_FLUSH_BYTES or time.time() - last_flush >= STREAM_FLUSH_INTERVAL):
+            render_start = time.time()
+            yield "".join(buffer)
+            stats["render_time"] += time.time() - render_start
+            stats["flushes"] += 1
+            buffer = []
+            buffered_bytes = 0
+            last_flush = time.time()
+    if buffer:
+        render_start = time.time()
+        yield "".join(buffer)
+        stats["render_time"] += time.time() - render_start
+        stats["flushes"] += 1
+
+def format_stream_progress(stats):
+    """Progress line shown instead of the text when live rendering is off."""
+    elapsed = max(time.time() - stats["start"], 1e-6)
+    if stats.get("queued") and "queue_wait" not in stats:
+        return f"🚦 Waiting in the API queue... {elapsed:.0f}s"
+    return f"⏳ {stats['chunks']} chunks · {stats['bytes'] / 1024:.1f} KB · {stats['chunks'] / elapsed:.0f} chunks/s"
+
+def record_render_stats(stats):
+    """Keeps the last few calls' throughput and render overhead for the sidebar."""
+    duration = max(time.time() - stats["start"], 1e-6)
+    stats = dict(stats, duration=duration, chunks_per_second=stats["chunks"] / duration, render_overhead=stats["render_time"] / duration)
+    history = st.session_state.setdefault('render_stats', [])
+    history.append(stats)
+    del history[:-RENDER_STATS_HISTORY]
+    return stats
+
+def wait_for_wordware_job(job, stream_container=None):
+    """
+    Renders a job's chunks from the script thread (Streamlit elements can't be written from the loop thread)
+    and returns its final output, or None if the call failed.
+    """
+    stats = new_render_stats(job)
+    cancel_slot = render_cancel_button(job)
+    status = st.empty()
+    on_idle = heartbeat(status, stats)
+    if stream_container and st.session_state.get('live_stream_rendering', True):
+        replay_speed = st.session_state.get('cache_replay_speed', 0)
+        stream_container.write_stream(coalesce_text(job_text_pieces(job, stats, replay_speed, on_idle), stats))
+    elif stream_container:
+        for _ in coalesce_text(job_text_pieces(job, stats, on_idle=on_idle), stats):
+            stream_container.caption(format_stream_progress(stats))
+    else:
+        # If not streaming to UI, just consume the events to get the final output
+        for _ in job_text_pieces(job, stats, on_idle=on_idle):
+            pass
+    cancel_slot.empty()
+    status.empty()
+    record_render_stats(stats)
+    finish_session_job(job)
+
+    try:
+        return job_result(job)
+    except CancelledError:
+        st.warning(f"⏹ {APP_NAMES.get(job['app_id'], job['app_id'])} was cancelled.")
+        return None
+    except httpx.HTTPError as e:
+        report_wordware_error(e, job.get("partial"))
+        return None
+
+def process_wordware_api(app_id, inputs, stream_container=None, use_cache=True, priority="interactive"):
+    """
+    Calls a Wordware API endpoint, handles streaming responses, and returns the final output.
+    If a stream_container is provided, it writes chunks to it in real-time.
+    Finished runs are cached on disk; pass use_cache=False to force a fresh run.
+    Blocking wrapper over run_wordware_app.
+    """
+    job = submit_wordware_call(app_id, inputs, use_cache=use_cache and is_wordware_cache_enabled(app_id), priority=priority)
+    return wait_for_wordware_job(job, stream_container)
+
+def process_wordware_batch(calls, max_concurrency=None, priority="bulk"):
+    """
+    Runs several independent Wordware calls concurrently on the shared event loop.
+    Each call is a dict with 'app_id', 'inputs' and optionally 'container', 'use_cache' and 'single_flight'.
+    Streams are rendered round-robin into their containers once per STREAM_FLUSH_INTERVAL;
+    returns the outputs in order (None for failures).
+    """
+    if not calls:
+        return []
+    semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency else None
+    jobs = []
+    for call in calls:
+        use_cache = call.get('use_cache', True) and is_wordware_cache_enabled(call['app_id'])
+        jobs.append(submit_wordware_call(call['app_id'], call['inputs'], use_cache=use_cache, semaphore=semaphore, single_flight=call.get('single_flight', True), priority=priority))
+
+    cancel_slot = st.empty()
+    cancel_slot.button(f"⏹ Cancel all {len(jobs)} calls", key=f"cancel_{jobs[0]['id']}", on_click=cancel_session_jobs, args=("cancelled",))
+    status = st.empty()
+    last_beat = 0.0
+
+    live = st.session_state.get('live_stream_rendering', True)
+    stats = [new_render_stats(job) for job in jobs]
+    texts = [[] for _ in jobs]
+    finished = [False for _ in jobs]
+    while not all(finished):
+        if time.time() - last_beat >= 1.0:
+            # Keeps the script interruptible for the cancel button while every stream is quiet
+            status.caption(f"⏳ {sum(finished)}/{len(jobs)} finished")
+            last_beat = time.time()
+        for i, job in enumerate(jobs):
+            updated = False
+            while not finished[i]:
+                try:
+                    event = job["events"].get_nowait()
+                except queue.Empty:
+                    break
+                if event is None:
+                    finished[i] = True
+                    record_render_stats(stats[i])
+                    break
+                pieces = list(job_event_text(job, event, stats[i]))
+                texts[i].extend(pieces)
+                updated = updated or bool(pieces)
+            container = calls[i].get('container')
+            if updated and container:
+                render_start = time.time()
+                container.markdown("".join(texts[i]) if live else format_stream_progress(stats[i]))
+                stats[i]["render_time"] += time.time() - render_start
+                stats[i]["flushes"] += 1
+        time.sleep(STREAM_FLUSH_INTERVAL)
+    cancel_slot.empty()
+    status.empty()
+
+    results = []
+    for job in jobs:
+        finish_session_job(job)
+        try:
+            results.append(job_result(job))
+        except CancelledError:
+            st.warning(f"⏹ {APP_NAMES.get(job['app_id'], job['app_id'])} was cancelled.")
+            results.append(None)
+        except httpx.HTTPError as e:
+            report_wordware_error(e, job.get("partial"))
+            results.append(None)
+    return results
+
+# --- DOCUMENT PARSING ---
+
+def count_pdf_pages(path):
+    # An open file keeps pypdf reading on demand; given a path it would load the whole file into memory
+    with open(path, 'rb') as f:
+        return len(PdfReader(f).pages)
+
+def split_pdf_pages(path, pages_per_shard):
+    """
+    Splits a PDF into (first_page, last_page, shard_path) shards of up to pages_per_shard pages, numbered from 1.
+    Each shard is written straight to its own temp file; the caller deletes them.
+    """
+    shards = []
+    page_count = count_pdf_pages(path)
+    for first in range(0, page_count, pages_per_shard):
+        # A fresh reader per shard, since a reader keeps every object it has resolved
+        with open(path, 'rb') as f:
+            writer = PdfWriter()
+            for page in PdfReader(f).pages[first:first + pages_per_shard]:
+                writer.add_page(page)
+            with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
+                writer.write(tmp_file)
+        # pypdf readers and writers reference each other, so without this every shard stays in memory until the next collection
+        del writer
+        gc.collect()
+        shards.append((first + 1, min(first + pages_per_shard, page_count), tmp_file.name))
+    return shards
+
+async def llamaparse_documents(parser, path):
+    """Runs one LlamaParse job on a PDF file and returns its documents."""
+    return await parser.aload_data(path)
+
+async def parse_pdf_shards(parser, shards, pdf_hash, parsing_instruction, emit, use_cache):
+    """
+    Parses page-range shards concurrently, at most PARSE_SHARD_WORKERS at a time, and returns
+    (markdown, page_count) with the shards stitched back in page order.
+    A failing shard is retried on its own; shards that succeed are cached even if another one
+    ultimately fails, so processing the document again only re-parses the failed ranges.
+    """
+    semaphore = asyncio.Semaphore(PARSE_SHARD_WORKERS)
+    progress = {"done": 0, "total": len(shards)}
+
+    async def parse_shard(first, last, shard_path):
+        cache_key = parse_cache_key(pdf_hash, parsing_instruction, LLAMAPARSE_RESULT_TYPE, pages=(first, last))
+        cached = await asyncio.to_thread(disk_cache_get, PARSE_CACHE_DIR, cache_key, PARSE_CACHE_TTL) if use_cache else None
+        if cached is not None:
+            markdown, pages = cached["markdown"], cached["pages"]
+        else:
+            attempt = 0
+            while True:
+                try:
+                    async with semaphore:
+                        documents = await llamaparse_documents(parser, shard_path)
+                    break
+                except Exception as e:
+                    if attempt >= PARSE_SHARD_MAX_RETRIES:
+                        raise
+                    delay = retry_delay(attempt, e)
+                    attempt += 1
+                    emit('shard_retry', {"pages": f"{first}-{last}", "attempt": attempt, "delay": delay, "reason": str(e)})
+                    await asyncio.sleep(delay)
+            markdown = PAGE_BREAK.join([doc.text for doc in documents])
+            pages = len(documents)
+            await asyncio.to_thread(disk_cache_put, PARSE_CACHE_DIR, cache_key, {"pages": pages, "markdown": markdown}, PARSE_CACHE_MAX_BYTES)
+        progress["done"] += 1
+        emit('pages', (first, last, markdown))
+        emit('shards', dict(progress))
+        return markdown, pages
+
+    emit('shards', dict(progress))
+    try:
+        results = await asyncio.gather(*(parse_shard(*shard) for shard in shards), return_exceptions=True)
+    finally:
+        for _, _, shard_path in shards:
+            os.unlink(shard_path)
+    failed = [(shard, result) for shard, result in zip(shards, results) if isinstance(result, BaseException)]
+    if failed:
+        ranges = ", ".join(f"{first}-{last}" for (first, last, _), _ in failed)
+        raise RuntimeError(f"Pages {ranges} failed after {PARSE_SHARD_MAX_RETRIES + 1} attempts ({failed[0][1]}). The other page ranges are cached, so processing again only re-parses these.")
+    return PAGE_BREAK.join(markdown for markdown, _ in results), sum(pages for _, pages in results)
+
+async def run_llamaparse(pdf, label, parsing_instruction, emit=None, use_cache=True):
+    """
+    Parses a spooled PDF (see spool_upload) with LlamaParse on the current event loop and returns all pages
+    combined into a single markdown string.
+    PDFs over PARSE_SHARD_MIN_PAGES pages are split into page ranges and parsed concurrently.
+    Results are cached on disk by PDF hash, instruction and result type; use_cache=False forces a fresh parse,
+    which also skips LlamaParse's own server-side cache. emit receives ('cached', None) on a cache hit
+    and ('shards', progress) / ('shard_retry', info) while a sharded parse runs. Parsed text is also
+    emitted as ('page_count', total) and ('pages', (first_page, last_page, markdown)) as it arrives.
+    The call is recorded in the metrics log as 'llamaparse_<label>', with the first page range as its first chunk.
+    """
+    notify = emit or (lambda kind, payload: None)
+    metrics = new_call_metrics("llamaparse", f"llamaparse_{label}", pdf["size"])
+
+    def emit(kind, payload):
+        if kind == 'pages' and metrics["ttfb"] is None:
+            metrics["ttfb"] = time.time() - metrics["start"]
+        notify(kind, payload)
+
+    try:
+        pdf_hash = pdf["sha256"]
+        cache_key = parse_cache_key(pdf_hash, parsing_instruction, LLAMAPARSE_RESULT_TYPE)
+        if use_cache:
+            cached = await asyncio.to_thread(disk_cache_get, PARSE_CACHE_DIR, cache_key, PARSE_CACHE_TTL)
+            if cached is not None:
+                metrics["ttfb"] = time.time() - metrics["start"]
+                metrics["chunks"] = cached.get("pages", 0)
+                metrics["output_bytes"] = len(cached["markdown"].encode('utf-8'))
+                metrics["outcome"] = "cached"
+                emit('cached', None)
+                return cached["markdown"]
+
+        parser = LlamaParse(
+            api_key=LLAMAPARSE_API_KEY,
+            result_type=LLAMAPARSE_RESULT_TYPE,
+            parsing_instruction=parsing_instruction,
+            verbose=True,
+            invalidate_cache=not use_cache
+        )
+
+        page_count = await asyncio.to_thread(count_pdf_pages, pdf["path"])
+        emit('page_count', page_count)
+        if page_count > PARSE_SHARD_MIN_PAGES:
+            shards = await asyncio.to_thread(split_pdf_pages, pdf["path"], PARSE_SHARD_PAGES)
+            metrics["shards"] = len(shards)
+            markdown, pages = await parse_pdf_shards(parser, shards, pdf_hash, parsing_instruction, emit, use_cache)
+        else:
+            documents = await llamaparse_documents(parser, pdf["path"])
+            # An unsharded parse arrives all at once
+            metrics["ttfb"] = time.time() - metrics["start"]
+            markdown = PAGE_BREAK.join([doc.text for doc in documents])
+            pages = len(documents)
+            if pages == page_count:
+                for page, doc in enumerate(documents, start=1):
+                    emit('pages', (page, page, doc.text))
+        metrics["chunks"] = pages
+        metrics["output_bytes"] = len(markdown.encode('utf-8'))
+        metrics["outcome"] = "ok" if markdown else "empty"
+        if markdown:
+            await asyncio.to_thread(disk_cache_put, PARSE_CACHE_DIR, cache_key, {"label": label, "markdown": markdown, "pages": pages}, PARSE_CACHE_MAX_BYTES)
+        return markdown
+    except asyncio.CancelledError as e:
+        metrics["outcome"] = e.args[0] if e.args else "cancelled"
+        raise
+    except Exception as e:
+        metrics["error"] = str(e)
+        raise
+    finally:
+        record_call_metrics(metrics)
+
+# Two or more spaces separate columns in pypdf's layout-mode text
+LOCAL_COLUMN_GAP = re.compile(r"\s{2,}")
+LOCAL_HEADING = re.compile(r"^(\d+(\.\d+)*\.?\s+\S|cap[ií]tulo\s|unidad\s)", re.IGNORECASE)
+LOCAL_TABLE_MIN_ROWS = 3
+LOCAL_BULLETS = ("•", "·", "▪", "◦", "-", "*", "–")
+
+def is_local_heading(line):
+    """Short lines without closing punctuation that are numbered, ALL CAPS or start a chapter read as headings."""
+    if len(line) > 80 or len(line.split()) > 12 or line[-1] in ".,;:" or not line[0].isalnum():
+        return False
+    return (bool(LOCAL_HEADING.match(line)) or line.isupper()) and any(c.isalpha() for c in line)
+
+def layout_text_to_markdown(text):
+    """Turns one page of layout-mode text into rough markdown: headings, paragraphs and pipe tables."""
+    blocks = []
+    paragraph = []
+    table = []
+
+    def flush_paragraph():
+        if paragraph:
+            blocks.append(" ".join(paragraph))
+            paragraph.clear()
+
+    def flush_table():
+        if len(table) >= LOCAL_TABLE_MIN_ROWS:
+            width = max(len(row) for row in table)
+            rows = [row + [""] * (width - len(row)) for row in table]
+            blocks.append("\n".join(
+                ["| " + " | ".join(rows[0]) + " |", "|" + " --- |" * width] + ["| " + " | ".join(row) + " |" for row in rows[1:]]
+            ))
+        else:
+            # Too short to be a table; keep the text as prose
+            paragraph.extend(" ".join(row) for row in table)
+        table.clear()
+
+    for raw_line in text.splitlines():
+        line = raw_line.strip()
+        if not line:
+            flush_table()
+            flush_paragraph()
+            continue
+        cells = LOCAL_COLUMN_GAP.split(line)
+        if cells[0] in LOCAL_BULLETS:
+            flush_table()
+            flush_paragraph()
+            blocks.append("- " + " ".join(cells[1:]))
+            continue
+        if len(cells) >= 2 and (not table or len(cells) == len(table[0])):
+            if not table:
+                flush_paragraph()
+            table.append(cells)
+            continue
+        flush_table()
+        line = " ".join(cells)
+        if is_local_heading(line):
+            flush_paragraph()
+            blocks.append(f"## {line}")
+        else:
+            paragraph.append(line)
+    flush_table()
+    flush_paragraph()
+    return "\n\n".join(blocks)
+
+def extract_page_markdown_locally(page):
+    """Rough markdown for one pypdf page from its text layer, without network calls. Scanned pages come out empty."""
+    if "/Contents" not in page:
+        # Blank page; pypdf's layout mode fails on these instead of returning nothing
+        return ""
+    return layout_text_to_markdown(page.extract_text(extraction_mode="layout") or "")
+
+def extract_pdf_markdown_locally(path):
+    """Rough markdown for each page of a PDF file."""
+    with open(path, 'rb') as f:
+        return [extract_page_markdown_locally(page) for page in PdfReader(f).pages]
+
+async def run_local_parse(pdf, label, parsing_instruction, emit=None, use_cache=True):
+    """
+    Local parse engine: draft markdown in seconds, recorded in the metrics log as 'local_<label>'.
+    Takes the same arguments and emits the same page events as run_llamaparse; the instruction and cache flag don't apply.
+    """
+    emit = emit or (lambda kind, payload: None)
+    metrics = new_call_metrics("local", f"local_{label}", pdf["size"])
+    try:
+        with open(pdf["path"], 'rb') as f:
+            reader = await asyncio.to_thread(PdfReader, f)
+            emit('page_count', len(reader.pages))
+            pages = []
+            for number, page in enumerate(reader.pages, start=1):
+                pages.append(await asyncio.to_thread(extract_page_markdown_locally, page))
+                emit('pages', (number, number, pages[-1]))
+        markdown = PAGE_BREAK.join(page for page in pages if page)
+        metrics["chunks"] = len(pages)
+        metrics["output_bytes"] = len(markdown.encode('utf-8'))
+        metrics["outcome"] = "ok" if markdown else "empty"
+        return markdown
+    except asyncio.CancelledError as e:
+        metrics["outcome"] = e.args[0] if e.args else "cancelled"
+        raise
+    except Exception as e:
+        metrics["error"] = str(e)
+        raise
+    finally:
+        record_call_metrics(metrics)
+
+async def run_wordware_parse(pdf, label, parsing_instruction, emit=None, use_cache=True):
+    """
+    Parses a spooled PDF with the Wordware parser apps for its label (see WORDWARE_PARSER_APPS), which read it
+    from a temporary public URL. The apps run concurrently and their outputs are joined in order; each returns
+    part of the document, so raises ValueError if any of them returns nothing. parsing_instruction is unused
+    since the apps carry their own prompts. Results are cached with the LlamaParse ones, keyed by PDF hash and app ids.
+    """
+    emit = emit or (lambda kind, payload: None)
+    apps = WORDWARE_PARSER_APPS.get(label)
+    if not apps:
+        raise ValueError(f"There is no Wordware parser app for {label}")
+    cache_key = parse_cache_key(pdf["sha256"], ",".join(APP_IDS[name] for name, _ in apps), "wordware")
+    if use_cache:
+        cached = await asyncio.to_thread(disk_cache_get, PARSE_CACHE_DIR, cache_key, PARSE_CACHE_TTL)
+        if cached is not None:
+            emit('cached', None)
+            return cached["markdown"]
+
+    url = (await race_uploads(pdf))["url"]
+    file_input = {"type": "file", "file_type": "application/pdf", "file_url": url, "file_name": pdf["name"]}
+    # Cancelling this task cancels every app run through gather
+    outputs = await asyncio.gather(*(
+        run_wordware_app(APP_IDS[name], {input_name: file_input}, use_cache=use_cache)
+        for name, input_name in apps
+    ))
+    texts = [(output if isinstance(output, str) else str(list(output.values())[0])) if output else "" for output in outputs]
+    missing = [name for (name, _), text in zip(apps, texts) if not text.strip()]
+    if missing:
+        raise ValueError(f"{', '.join(missing)} returned no output for {label}")
+    markdown = "\n\n".join(texts).strip()
+    if markdown:
+        await asyncio.to_thread(disk_cache_put, PARSE_CACHE_DIR, cache_key, {"label": label, "markdown": markdown}, PARSE_CACHE_MAX_BYTES)
+    return markdown
+
+def parse_quality(markdown, page_count):
+    """
+    Rough 0-1 score for parsed markdown: text coverage per page, scaled down by unreadable characters,
+    plus a small bonus for markdown structure (headings and tables) over a flat text dump.
+    """
+    text = markdown.strip()
+    if not text:
+        return 0.0
+    pages = max(page_count or 1, 1)
+    coverage = min(len(text) / pages / PARSE_GOOD_CHARS_PER_PAGE, 1.0)
+    garbage = sum(1 for ch in text if ch == "�" or (ord(ch) < 32 and ch not in "\n\t\f")) / len(text)
+    structure = min(len(re.findall(r"^(?:#{1,6} |\|)", text, re.MULTILINE)) / pages, 1.0)
+    return round(max(0.0, coverage * (1 - 10 * garbage)) * 0.9 + structure * 0.1, 3)
+
+async def race_parse_engines(engines, best_of, pdf, label, parsing_instruction, emit=None, use_cache=True):
+    """
+    Runs several parse engines on the same PDF at once, so a slow or degraded backend doesn't hold up Stage 1.
+    Hedged (best_of=False): the first result scoring at least PARSE_ACCEPT_SCORE wins and the rest are cancelled.
+    Best-of: after the first acceptable result the others get PARSE_BEST_OF_GRACE more seconds, then the
+    highest parse_quality wins. With no acceptable result, the best non-empty one is used.
+    emit receives ('race', {engine: status}) as backends finish and ('source', engine) for the winner;
+    only the first engine's pages are streamed to the page store.
+    """
+    emit = emit or (lambda kind, payload: None)
+    page_count = await asyncio.to_thread(count_pdf_pages, pdf["path"])
+    statuses = {name: "⏳" for name in engines}
+
+    def engine_emit(name):
+        def forward(kind, payload):
+            if kind in ('page_count', 'pages') and name != engines[0]:
+                return
+            emit(kind, payload)
+        return forward
+
+    tasks = {
+        asyncio.ensure_future(PARSE_ENGINES[name](pdf, label, parsing_instruction, engine_emit(name), use_cache)): name
+        for name in engines
+    }
+    pending = set(tasks)
+    results, errors = {}, {}
+    deadline = None
+    reason = "lost_race"
+    emit('race', dict(statuses))
+    try:
+        while pending:
+            timeout = max(0.0, deadline - time.time()) if deadline else None
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break  # best-of grace period is over
+            for task in done:
+                name = tasks[task]
+                if task.exception() is not None:
+                    errors[name] = task.exception()
+                    statuses[name] = "❌"
+                else:
+                    results[name] = (parse_quality(task.result() or "", page_count), task.result() or "")
+                    statuses[name] = f"✅ {results[name][0]:.2f}"
+            emit('race', dict(statuses))
+            if any(score >= PARSE_ACCEPT_SCORE for score, _ in results.values()):
+                if not best_of:
+                    break
+                deadline = deadline or time.time() + PARSE_BEST_OF_GRACE
+    except asyncio.CancelledError as e:
+        reason = e.args[0] if e.args else "cancelled"
+        raise
+    finally:
+        for task in pending:
+            task.cancel(reason)
+
+    candidates = {name: result for name, result in results.items() if result[1]}
+    if not candidates:
+        if errors:
+            raise next(iter(errors.values()))
+        return ""
+    winner = max(candidates, key=lambda name: candidates[name][0])
+    emit('source', winner)
+    return candidates[winner][1]
+
+async def run_hedged_parse(pdf, label, parsing_instruction, emit=None, use_cache=True):
+    return await race_parse_engines(PARSE_RACE_ENGINES, False, pdf, label, parsing_instruction, emit, use_cache)
+
+async def run_best_of_parse(pdf, label, parsing_instruction, emit=None, use_cache=True):
+    return await race_parse_engines(PARSE_RACE_ENGINES, True, pdf, label, parsing_instruction, emit, use_cache)
+
+# Parse engines by name; each is an async (spooled pdf, label, parsing_instruction, emit, use_cache) -> markdown
+PARSE_ENGINES = {
+    "llamaparse": run_llamaparse,
+    "local": run_local_parse,
+    "wordware": run_wordware_parse,
+    "hedged": run_hedged_parse,
+    "best_of": run_best_of_parse,
+}
+
+# Stage 1 parsing modes: (engine used while the user waits, engine that replaces it in the background)
+PARSE_MODES = {
+    "llamaparse": ("llamaparse", None),
+    "local": ("local", None),
+    "local_then_llamaparse": ("local", "llamaparse"),
+    "wordware": ("wordware", None),
+    "hedged": ("hedged", None),
+    "best_of": ("best_of", None),
+}
+PARSE_MODE_LABELS = {
+    "llamaparse": "LlamaParse",
+    "local": "Fast local (draft)",
+    "local_then_llamaparse": "Local first, then LlamaParse in the background",
+    "wordware": "Wordware parser apps",
+    "hedged": "LlamaParse vs Wordware (first good result)",
+    "best_of": "LlamaParse vs Wordware (best result)",
+}
+
+class ParsedPageStore:
+    """
+    Text of a document being parsed, filled in from the event loop as pages or page ranges arrive,
+    possibly out of order. Readers always get a consistent view: the contiguous pages from page 1,
+    optionally cut back to the last section that is known to be complete.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ranges = {}  # first page -> (last page, markdown)
+        self.total_pages = None
+        self.text = None
+        self.source = None  # engine whose text this is, which a race only knows at the end
+
+    def set_total(self, total_pages):
+        with self.lock:
+            self.total_pages = total_pages
+
+    def add(self, first, last, markdown):
+        with self.lock:
+            self.ranges[first] = (last, markdown)
+
+    def finish(self, markdown):
+        with self.lock:
+            self.text = markdown
+
+    def received_pages(self):
+        with self.lock:
+            return sum(last - first + 1 for first, (last, _) in self.ranges.items())
+
+    def prefix(self, complete_sections=False):
+        """Returns (markdown, page_count) for the contiguous pages parsed so far, or the full text once finished."""
+        with self.lock:
+            if self.text is not None:
+                return self.text, self.total_pages
+            parts = []
+            page = 1
+            while page in self.ranges:
+                last, markdown = self.ranges[page]
+                parts.append(markdown)
+                page = last + 1
+        text = PAGE_BREAK.join(parts)
+        if complete_sections:
+            # The last section may continue on a page that hasn't arrived yet
+            headings = [match.start() for match in re.finditer(r"^#{1,6} ", text, re.MULTILINE)]
+            if headings and headings[-1] > 0:
+                text = text[:headings[-1]].rstrip()
+        return text, page - 1
+
+def cancel_background_parses(reason="cancelled"):
+    for job in st.session_state.get('background_parses', {}).values():
+        cancel_job(job, reason)
+    st.session_state['background_parses'] = {}
+
+@st.fragment(run_every=5)
+def render_background_parses():
+    """Polls the parse jobs finishing in the background, and swaps their full text in as each one finishes."""
+    parses = st.session_state.background_parses
+    for label, job in list(parses.items()):
+        if not job["future"].done():
+            store = job["store"]
+            if st.session_state.document_sources.get(label) == "partial":
+                # Stages started from here see every complete section parsed so far
+                store_document_markdown(label, store.prefix(complete_sections=True)[0])
+                st.caption(f"⏳ Still parsing {job['file_name']} in the background... 📄 {store.received_pages()}/{store.total_pages or '?'} pages")
+            else:
+                st.caption(f"⏳ LlamaParse is refining {job['file_name']} in the background... {time.time() - job['start']:.0f}s")
+            continue
+        del parses[label]
+        try:
+            markdown = job_result(job)
+        except Exception as e:
+            st.toast(f"Background LlamaParse of {job['file_name']} failed, keeping the local draft: {e}", icon="⚠️")
+            continue
+        if not markdown:
+            continue
+        previous_source = st.session_state.document_sources.get(label)
+        store_document_markdown(label, markdown)
+        st.session_state.document_sources[label] = job["store"].source
+        complete_pipeline_node(label)
+        st.toast(f"✅ {job['file_name']} finished parsing ({len(markdown)} characters).")
+        if st.session_state.stage_2_status == 'completed':
+            draft = "the pages parsed at the time" if previous_source == "partial" else "the local draft"
+            st.toast(f"Stage 2 mapping was built from {draft}; update it to use the full text.", icon="ℹ️")
+    if not parses:
+        # Refresh the whole page so every stage sees the replaced text
+        st.rerun()
+
+def submit_parse_job(pdf, label, parsing_instruction, engine="llamaparse", use_cache=True, background=False):
+    """
+    Starts parsing a spooled PDF (see spool_upload) with one of PARSE_ENGINES on the shared event loop;
+    the job can be cancelled like a Wordware call. Background jobs outlive the script run that started
+    them, so they aren't registered for cancellation when the run ends.
+    """
+    lock = get_inflight_calls()["lock"]
+    events = queue.Queue()
+    call = {"log": [], "listeners": [events], "future": None, "task": None}
+    store = ParsedPageStore()
+    store.source = engine
+    retain_spooled_upload(pdf)
+
+    def emit(kind, payload):
+        # Page text goes to the store rather than the event queue
+        if kind == 'page_count':
+            store.set_total(payload)
+            return
+        if kind == 'pages':
+            store.add(*payload)
+            return
+        if kind == 'source':
+            store.source = payload
+            return
+        with lock:
+            for listener in call["listeners"]:
+                listener.put((kind, payload))
+
+    async def run():
+        with lock:
+            call["task"] = asyncio.current_task()
+        try:
+            markdown = await PARSE_ENGINES[engine](pdf, label, parsing_instruction, emit, use_cache)
+            store.finish(markdown)
+            return markdown
+        finally:
+            release_spooled_upload(pdf)
+            with lock:
+                for listener in call["listeners"]:
+                    listener.put(None)
+
+    with lock:
+        call["future"] = asyncio.run_coroutine_threadsafe(run(), get_event_loop())
+    job = {"id": f"job_{id(events)}", "app_id": f"{engine}_{label}", "file_name": pdf["name"], "start": time.time(), "store": store, "events": events, "future": call["future"], "call": call, "shared": False}
+    if not background:
+        register_session_job(job)
+    return job
+
+def continue_with_parsed_pages(jobs):
+    """
+    on_click handler that finishes Stage 1 early: finished documents are used as they are, and the ones
+    still parsing move to the background with the pages parsed so far as their text for now.
+    """
+    for label, job in jobs.items():
+        finish_session_job(job)
+        if job["future"].done():
+            if job["future"].cancelled() or job["future"].exception() is not None:
+                continue
+            store_document_markdown(label, job["future"].result())
+            st.session_state.document_sources[label] = job["store"].source
+        else:
+            store_document_markdown(label, job["store"].prefix(complete_sections=True)[0])
+            st.session_state.document_sources[label] = "partial"
+            st.session_state.background_parses[label] = job
+    if "project_brief" not in jobs:
+        st.session_state.project_brief_md = ""
+    complete_pipeline_node("compendio")
+    complete_pipeline_node("project_brief")
+    st.session_state.stage_1_status = 'completed'
+
+def wait_for_parse_jobs(jobs, required=(), allow_partial=False):
+    """
+    Waits for several parse jobs at once, showing a status line per document and one cancel button for all of them.
+    (A click reruns the script, which abandons every job it was waiting on, so a per-document button
+    would cancel the other documents too.)
+    If a job listed in required fails, the others are cancelled since their output can't be used.
+    With allow_partial, a button lets the user continue with the pages parsed so far once the required documents have some.
+    Returns {label: markdown, or the exception the parse raised (CancelledError if it was cancelled)}.
+    """
+    rows = {label: st.empty() for label in jobs}
+    cancel_slot = st.empty()
+    cancel_slot.button(
+        "⏹ Cancel parsing" if len(jobs) == 1 else f"⏹ Cancel all {len(jobs)} documents",
+        key=f"cancel_{'_'.join(job['id'] for job in jobs.values())}",
+        on_click=cancel_session_jobs,
+        args=("cancelled",)
+    )
+    continue_slot = st.empty() if allow_partial else None
+
+    start_time = time.time()
+    results = {}
+    while len(results) < len(jobs):
+        elapsed = time.time() - start_time
+        for label, job in jobs.items():
+            if label in results:
+                continue
+            status = rows[label]
+            # Checked before draining, since every event is queued before the job finishes
+            finished = job["future"].done()
+            progress = job.setdefault("progress", {})
+            while True:
+                try:
+                    event = job["events"].get_nowait()
+                except queue.Empty:
+                    break
+                if event is not None:
+                    progress[event[0]] = event[1]
+            if not finished:
+                detail = ""
+                store = job["store"]
+                if store.total_pages:
+                    detail = f" · 📄 {store.received_pages()}/{store.total_pages} pages"
+                if "shards" in progress:
+                    detail += f" · {progress['shards']['done']}/{progress['shards']['total']} page ranges"
+                if "shard_retry" in progress:
+                    detail += f" · retried pages {progress['shard_retry']['pages']}"
+                if "race" in progress:
+                    detail += " · " + ", ".join(f"{PARSE_MODE_LABELS[name]} {status}" for name, status in progress["race"].items())
+                status.caption(f"⏳ Parsing {job['file_name']}... {elapsed:.0f}s{detail}")
+                continue
+            finish_session_job(job)
+            try:
+                results[label] = job_result(job)
+                from_cache = 'cached' in progress
+                status.caption(f"{'⚡' if from_cache else '✅'} {job['file_name']} {'loaded from cache' if from_cache else 'parsed'} in {elapsed:.0f}s · {len(results[label])} characters")
+            except CancelledError as e:
+                results[label] = e
+                status.caption(f"⏹ {job['file_name']} cancelled")
+            except Exception as e:
+                results[label] = e
+                status.caption(f"❌ {job['file_name']} failed after {elapsed:.0f}s")
+            if label in required and isinstance(results[label], Exception):
+                for other in jobs.values():
+                    if not other["future"].done():
+                        cancel_job(other)
+        pending = [job["future"] for label, job in jobs.items() if label not in results]
+        if continue_slot is not None and pending and all(label in results or jobs[label]["store"].prefix()[1] > 0 for label in required):
+            # Rendered once; the click reruns the script, which ends this wait
+            continue_slot.button(
+                "▶ Continue with the pages parsed so far",
+                key=f"continue_{'_'.join(job['id'] for job in jobs.values())}",
+                on_click=continue_with_parsed_pages,
+                args=(jobs,),
+                help="Later stages start on the parsed pages; the rest keeps parsing in the background and replaces the text when it's done."
+            )
+            continue_slot = None
+        if pending:
+            # Wakes up as soon as a parse finishes, so cache hits don't wait out the refresh interval
+            futures_wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+    cancel_slot.empty()
+    return results
+
+# --- DOCUMENT NORMALIZATION ---
+
+def boilerplate_key(line):
+    """
+    Running headers usually carry the page number, so digits are ignored when comparing them.
+    Headings keep theirs, or every "# Capítulo N" at the top of a page would look like a running header.
+    """
+    line = line.strip()
+    if line.startswith("#"):
+        return line.lower()
+    return re.sub(r"\d+", "#", line).lower()
+
+def normalize_document(markdown):
+    """
+    Shrinks parsed markdown before it's sent to the Wordware apps: drops running headers, footers and
+    page numbers, collapses runs of spaces and blank lines, and drops pages identical to an earlier one.
+    The result only depends on the input. Returns (text, report); report["offsets"] maps offsets in the
+    text back to the raw markdown (see original_offset).
+    """
+    # (raw offset, line) for every line, page by page
+    pages = []
+    offset = 0
+    for page_text in markdown.split("\f"):
+        lines = []
+        for line in page_text.split("\n"):
+            lines.append((offset, line))
+            offset += len(line) + 1
+        pages.append(lines)
+
+    def edge_lines(lines):
+        filled = [i for i, (_, line) in enumerate(lines) if line.strip()]
+        return set(filled[:NORMALIZE_EDGE_LINES] + filled[-NORMALIZE_EDGE_LINES:])
+
+    edges = [edge_lines(lines) for lines in pages]
+    page_counts = collections.Counter()
+    for lines, edge in zip(pages, edges):
+        page_counts.update({
+            boilerplate_key(lines[i][1]) for i in edge
+            if len(lines[i][1].strip()) <= NORMALIZE_BOILERPLATE_MAX_CHARS and not NORMALIZE_KEEP_LINE.match(lines[i][1])
+        })
+    min_pages = max(NORMALIZE_BOILERPLATE_MIN_PAGES, NORMALIZE_BOILERPLATE_SHARE * len(pages))
+    boilerplate = {key for key, count in page_counts.items() if count >= min_pages}
+
+    report = {"pages": len(pages), "boilerplate_lines": 0, "page_numbers": 0, "duplicate_pages": 0}
+    out = []
+    norm_starts, raw_starts = [], []
+    position = 0
+    seen_pages = set()
+    for lines, edge in zip(pages, edges):
+        kept = []
+        for i, (raw_offset, line) in enumerate(lines):
+            if i in edge:
+                if PAGE_NUMBER_LINE.match(line.strip()):
+                    report["page_numbers"] += 1
+                    continue
+                if boilerplate_key(line) in boilerplate:
+                    report["boilerplate_lines"] += 1
+                    continue
+            # Leading indentation is kept since it can be markdown structure
+            kept.append((raw_offset, re.sub(r"(?<=\S)[ \t]{2,}", " ", line.rstrip())))
+        page_key = "\n".join(line for _, line in kept if line)
+        if len(page_key) >= NORMALIZE_DUPLICATE_MIN_CHARS:
+            if page_key in seen_pages:
+                report["duplicate_pages"] += 1
+                continue
+            seen_pages.add(page_key)
+        for raw_offset, line in kept:
+            if not line and (not out or out[-1] == ""):
+                continue
+            if out:
+                position += 1  # the newline before this line
+            # Offsets only shift where something was dropped, so only those points are stored
+            if not norm_starts or raw_offset - position != raw_starts[-1] - norm_starts[-1]:
+                norm_starts.append(position)
+                raw_starts.append(raw_offset)
+            out.append(line)
+            position += len(line)
+        if out and out[-1] != "":
+            # Pages are separated by a blank line
+            out.append("")
+            position += 1
+
+    text = "\n".join(out).strip("\n")
+    report["raw_bytes"] = len(markdown.encode('utf-8'))
+    report["bytes"] = len(text.encode('utf-8'))
+    report["offsets"] = (norm_starts, raw_starts)
+    return text, report
+
+def original_offset(report, offset):
+    """Maps a character offset in normalized text to the raw markdown it came from (exact at line starts)."""
+    norm_starts, raw_starts = report["offsets"]
+    i = bisect.bisect_right(norm_starts, offset) - 1
+    if i < 0:
+        return offset
+    return raw_starts[i] + offset - norm_starts[i]
+
+def store_document_markdown(label, markdown):
+    """Saves a parsed document for the later stages: the raw text, its normalized version and the normalization report."""
+    text, report = normalize_document(markdown)
+    st.session_state[f"{label}_raw_md"] = markdown
+    st.session_state[f"{label}_md"] = text
+    st.session_state.document_normalization[label] = report
+
+def format_normalization_report(label, report):
+    saved = report["raw_bytes"] - report["bytes"]
+    share = saved / report["raw_bytes"] if report["raw_bytes"] else 0
+    return (
+        f"🧹 {label}: {report['raw_bytes'] / 1024:.0f} KB → {report['bytes'] / 1024:.0f} KB "
+        f"({share:.0%} smaller on every call) · removed {report['boilerplate_lines']} header/footer lines, "
+        f"{report['page_numbers']} page numbers and {report['duplicate_pages']} duplicate pages"
+    )
+
+# --- MAPPING MERGE ---
+
+def pack_pieces(pieces, max_chars):
+    """Joins consecutive pieces into chunks of at most max_chars (a single longer piece is sliced)."""
+    chunks = []
+    current = ""
+    for piece in pieces:
+        while len(piece) > max_chars:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(piece[:max_chars])
+            piece = piece[max_chars:]
+        if current and len(current) + len(piece) > max_chars:
+            chunks.append(current)
+            current = ""
+        current += piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+def split_mapping_sections(markdown, max_chars=MAPPING_SECTION_CHARS):
+    """
+    Splits a document at its headings into sections of at most max_chars, packing short sections together.
+    A section longer than max_chars is split at paragraph breaks instead.
+    """
+    starts = [0] + [match.start() for match in MAPPING_HEADING_LINE.finditer(markdown) if match.start() > 0]
+    pieces = []
+    for start, end in zip(starts, starts[1:] + [len(markdown)]):
+        section = markdown[start:end]
+        pieces.extend([section] if len(section) <= max_chars else re.split(r"(?<=\n\n)", section))
+    return pack_pieces(pieces, max_chars)
+
+def mapping_sections():
+    """The compendio sections chunked Stage 2 maps over, or None when the apps get the whole compendio."""
+    if not st.session_state.get('chunked_mapping'):
+        return None
+    sections = split_mapping_sections(st.session_state.compendio_md)
+    return sections if len(sections) > 1 else None
+
+def parse_mapping(value):
+    """Mapping apps may return their JSON as text; anything that doesn't parse is kept as it is."""
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except json.JSONDecodeError:
+            return value
+    return value
+
+def entry_id(entry, id_pattern):
+    """The id an entry owns, i.e. a field that is exactly an id like 'REF-003' ('id' first), or None."""
+    if not isinstance(entry, dict) or id_pattern is None:
+        return None
+    for value in ([entry["id"]] if "id" in entry else []) + list(entry.values()):
+        if isinstance(value, str) and id_pattern.fullmatch(value.strip()):
+            return value.strip()
+    return None
+
+def mapping_entry_key(entry, id_pattern):
+    """What makes two entries the same across sections: their longest text other than ids, normalized."""
+    texts = [value for value in entry.values() if isinstance(value, str) and not id_pattern.fullmatch(value.strip())]
+    text = max(texts, key=len) if texts else json.dumps(entry, sort_keys=True, ensure_ascii=False)
+    return re.sub(r"\W+", " ", id_pattern.sub("", text).lower()).strip()
+
+def mapping_entries(value):
+    """Every dict inside a mapping, depth first."""
+    if isinstance(value, dict):
+        yield value
+        children = value.values()
+    elif isinstance(value, list):
+        children = value
+    else:
+        return
+    for child in children:
+        yield from mapping_entries(child)
+
+def mapping_strings(value):
+    """Every string inside a mapping, keys included."""
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for key, child in value.items():
+            yield key
+            yield from mapping_strings(child)
+    elif isinstance(value, list):
+        for child in value:
+            yield from mapping_strings(child)
+
+def rewrite_ids(value, id_pattern, renames):
+    """Copy of a mapping with every id in renames replaced, in keys and text alike."""
+    if isinstance(value, dict):
+        return {rewrite_ids(key, id_pattern, renames): rewrite_ids(child, id_pattern, renames) for key, child in value.items()}
+    if isinstance(value, list):
+        return [rewrite_ids(child, id_pattern, renames) for child in value]
+    if isinstance(value, str):
+        return id_pattern.sub(lambda match: renames.get(match.group(0), match.group(0)), value)
+    return value
+
+def reconcile_mapping_ids(sections, prefix):
+    """
+    Each section's call numbers its entries from 1 ('REF-001', 'TAB-001'...). Renumbers them into one
+    sequence in order of first appearance, giving an entry found in several sections (see mapping_entry_key)
+    the same id everywhere. Ids a section mentions without owning an entry are left alone.
+    """
+    id_pattern = re.compile(rf"\b{prefix}-\d+\b")
+    global_ids = {}
+    reconciled = []
+    for section in sections:
+        renames = {}
+        for entry in mapping_entries(section):
+            local_id = entry_id(entry, id_pattern)
+            if local_id is None or local_id in renames:
+                continue
+            key = mapping_entry_key(entry, id_pattern)
+            renames[local_id] = global_ids.setdefault(key, f"{prefix}-{len(global_ids) + 1:03d}")
+        reconciled.append(rewrite_ids(section, id_pattern, renames))
+    return reconciled
+
+def merge_mapping_values(values, id_pattern=None):
+    """
+    Merges the same field from several sections: dicts field by field, lists concatenated (dropping entries
+    that own an id already seen, and repeated plain values), counts added up, and text from the first
+    section that has any. Plain text mappings are joined. Entries without an id are all kept, since the
+    same citation in two sections is two citations.
+    """
+    present = [value for value in values if value not in (None, "", [], {})]
+    if not present:
+        return values[0] if values else None
+    if all(isinstance(value, dict) for value in present):
+        fields = dict.fromkeys(field for value in present for field in value)
+        merged = {field: merge_mapping_values([value[field] for value in present if field in value], id_pattern) for field in fields}
+        # A count of a list in the same dict follows the merged list, duplicates dropped
+        lists = [field for field, value in merged.items() if isinstance(value, list)]
+        for field, value in merged.items():
+            if isinstance(value, int) and len(lists) == 1 and all(
+                    section.get(field) == len(section.get(lists[0]) or []) for section in present if field in section):
+                merged[field] = len(merged[lists[0]])
+        return merged
+    if all(isinstance(value, list) for value in present):
+        merged = []
+        seen = set()
+        for item in (item for value in present for item in value):
+            identity = entry_id(item, id_pattern) or (item if isinstance(item, (str, int, float)) else None)
+            if identity is None or identity not in seen:
+                seen.add(identity)
+                merged.append(item)
+        return merged
+    if all(isinstance(value, int) and not isinstance(value, bool) for value in present):
+        return sum(present)
+    if all(isinstance(value, str) for value in present):
+        return present[0] if len(set(present)) == 1 else "\n\n".join(present)
+    return present[0]
+
+def merge_mapping_sections(results, prefix=None):
+    """Merges per-section mapping results into one, reconciling the ids with the given prefix first."""
+    sections = [parse_mapping(result) for result in results]
+    if prefix:
+        sections = reconcile_mapping_ids(sections, prefix)
+    return merge_mapping_values(sections, re.compile(rf"\b{prefix}-\d+\b") if prefix else None)
+
+def validate_merged_mapping(output):
+    """
+    Checks a merged mapping has the shape later stages read: a 'referencias', 'citas' and 'tablas' mapping,
+    with the in-text citations as a list under citas.citas_en_texto. Raises ValueError if not.
+    Returns warnings about ids that don't line up: REF/TAB ids mentioned but never defined, or defined twice.
+    """
+    for part in MERGED_MAPPING_PARTS:
+        if not isinstance(output.get(part), (dict, list)):
+            raise ValueError(f"'{part}' is {type(output.get(part)).__name__}, not a JSON mapping")
+    if not isinstance(output["citas"], dict) or not isinstance(output["citas"].get("citas_en_texto"), list):
+        raise ValueError("'citas' has no citas_en_texto list")
+
+    warnings = []
+    mentioned = set(re.findall(r"(?:REF|TAB)-\d+\b", json.dumps(output, ensure_ascii=False)))
+    for prefix, part in (("REF", "referencias"), ("TAB", "tablas")):
+        id_pattern = re.compile(rf"\b{prefix}-\d+\b")
+        defined = [entry_id(entry, id_pattern) for entry in mapping_entries(output[part])]
+        defined = collections.Counter(id for id in defined if id)
+        duplicates = sorted(id for id, count in defined.items() if count > 1)
+        if duplicates:
+            warnings.append(f"{prefix} ids defined more than once: {', '.join(duplicates[:10])}")
+        undefined = sorted(id for id in mentioned - set(defined) if id.startswith(prefix))
+        if defined and undefined:
+            warnings.append(f"{prefix} ids mentioned but not defined: {', '.join(undefined[:10])}")
+    return warnings
+
+def merge_mappings_locally(referencias, citas, tablas):
+    """
+    Builds what the mapping_logic app returns, {"Merger": {"output": {"referencias", "citas", "tablas"}}},
+    from the three Stage 2 mappings. Raises ValueError if the result fails validate_merged_mapping;
+    returns (result, warnings).
+    """
+    output = {"referencias": parse_mapping(referencias), "citas": parse_mapping(citas), "tablas": parse_mapping(tablas)}
+    if isinstance(output["citas"], list):
+        output["citas"] = {"citas_en_texto": output["citas"]}
+    warnings = validate_merged_mapping(output)
+    return {"Merger": {"output": output}}, warnings
+
+def merge_mappings_node():
+    """
+    'local' step of the mapping_combined node: merges in-process when local merging is on. Returns None
+    (so the node calls mapping_logic instead) if it's off or the merge fails validation.
+    """
+    if not st.session_state.get('local_mapping_merge', True):
+        return None
+    start = time.time()
+    try:
+        result, warnings = merge_mappings_locally(st.session_state.mapping_referencias.value, st.session_state.mapping_citas.value, st.session_state.mapping_tablas.value)
+    except ValueError as e:
+        st.toast(f"Local merge failed validation ({e}); using the mapping_logic app instead.", icon="⚠️")
+        return None
+    for warning in warnings:
+        st.toast(warning, icon="ℹ️")
+    st.toast(f"Mappings merged locally in {(time.time() - start) * 1000:.0f} ms.")
+    return result
+
+# --- CITATION EXTRACTION ---
+
+def citation_key(surname, year):
+    """
+    Normalized author/year key shared by citations and bibliography entries, e.g. 'lopez2019a'. Only the
+    last word of the surname counts, so 'García López', 'Según García López' and 'López' agree.
+    """
+    surname = unicodedata.normalize("NFKD", surname.split()[-1]).encode("ascii", "ignore").decode("ascii").lower()
+    return re.sub(r"[^a-z]", "", surname) + re.sub(r"[^0-9a-z]", "", year.lower())
+
+def reference_key(text):
+    """citation_key of a bibliography entry's first author and year, or None if it doesn't start with an author."""
+    match = REFERENCE_AUTHOR_YEAR.match(re.sub(r"[*_`]", "", text).strip())
+    return citation_key(match.group("surname"), match.group("year")) if match else None
+
+def bibliography_spans(markdown):
+    """(start, end) of every bibliography section: from a References/Bibliografía heading to the next heading as high."""
+    spans = []
+    for match in BIBLIOGRAPHY_HEADING.finditer(markdown):
+        level = len(match.group(1) or "#")
+        following = re.compile(rf"^#{{1,{level}}}\s", re.MULTILINE).search(markdown, match.end())
+        spans.append((match.end(), following.start() if following else len(markdown)))
+    return spans
+
+def bibliography_entries(text):
+    """
+    Splits a bibliography section into entries: a new one starts after a blank line, at a bullet or an
+    'Author,' line, or at a line with an author and '(year)' near its start.
+    """
+    entries = []
+    continuing = False
+    for line in text.splitlines():
+        line = line.strip().strip("\f")
+        if not line:
+            # A blank line always ends an entry
+            continuing = False
+            continue
+        start = REFERENCE_START.match(line)
+        if start or not continuing or REFERENCE_YEAR_START.match(line):
+            entries.append(line[start.end():] if start else line)
+        else:
+            entries[-1] += " " + line
+        continuing = True
+    return entries
+
+def extract_citation_index(markdown):
+    """
+    Finds the bibliography and in-text citations of a document in one scan, without any API call.
+    Returns {"referencias": [{"id", "referencia", "clave", "autor", "anio"}], "citas_en_texto": [{"texto",
+    "inicio", "fin", "clave", "referencia"}], "seconds"}: offsets index into the markdown, and each citation's
+    "referencia" is the REF id of the bibliography entry with the same key (None if there's none).
+    """
+    start_time = time.time()
+    spans = bibliography_spans(markdown)
 
-        # User settings for Stage 3
-        'topic_input': "", 'reference_count': 25, 'page_count': "40-50", 'subtemas_enabled': False,
+    referencias = []
+    ids_by_key = {}
+    seen = set()
+    for span_start, span_end in spans:
+        for entry in bibliography_entries(markdown[span_start:span_end]):
+            plain = re.sub(r"[*_`]", "", entry).strip()
+            match = REFERENCE_AUTHOR_YEAR.match(plain)
+            if not match or plain in seen:
+                continue
+            seen.add(plain)
+            key = citation_key(match.group("surname"), match.group("year"))
+            ref_id = f"REF-{len(referencias) + 1:03d}"
+            ids_by_key.setdefault(key, ref_id)
+            acronym = REFERENCE_ACRONYM.search(plain, 0, match.start("year"))
+            if acronym:
+                ids_by_key.setdefault(citation_key(acronym.group(1), match.group("year")), ref_id)
+            referencias.append({"id": ref_id, "referencia": plain, "clave": key, "autor": match.group("surname"), "anio": match.group("year")})
 
-        # File management
-        'uploaded_files': {},
+    citas = []
+    span_starts = [span_start for span_start, _ in spans]
+    for match in CITATION_PATTERN.finditer(markdown):
+        # The bibliography's own entries aren't citations
+        span = bisect.bisect_right(span_starts, match.start()) - 1
+        if span >= 0 and match.start() < spans[span][1]:
+            continue
+        narrative_years = CITATION_NARRATIVE_YEARS.fullmatch(match.group("paren"))
+        narrative = None
+        if narrative_years:
+            # Searching only the stretch of line just before the parentheses keeps long capitalized runs cheap
+            line_start = markdown.rfind("\n", 0, match.start()) + 1
+            narrative = CITATION_NARRATIVE_AUTHORS.search(markdown, max(line_start, match.start() - CITATION_AUTHORS_WINDOW), match.start())
+        if narrative:
+            surname, years = narrative.group("surname"), narrative_years.group("n_years")
+            parts = [(narrative.start(), match.end(), surname, year) for year in re.findall(CITATION_YEAR, years)]
+        else:
+            # A parenthetical citation can hold several: (García, 2019; López y Pérez, 2020a, 2021)
+            parts = []
+            for part in re.finditer(r"[^;()]+", match.group("paren")):
+                cited = CITATION_PART.match(part.group(0))
+                if cited:
+                    part_start = match.start("paren") + part.start()
+                    part_end = match.start("paren") + part.end()
+                    parts.extend((part_start, part_end, cited.group("surname"), year) for year in re.findall(CITATION_YEAR, cited.group("years")))
+        for part_start, part_end, surname, year in parts:
+            key = citation_key(surname, year)
+            citas.append({"texto": markdown[part_start:part_end].strip(), "inicio": part_start, "fin": part_end, "clave": key, "referencia": ids_by_key.get(key)})
 
-        # Intermediate outputs for modular recovery
-        'stage_1_1_output': "", 'stage_1_2_output': "",
-        'mapping_referencias': "", 'mapping_citas': "", 'mapping_tablas': "",
+    return {"referencias": referencias, "citas_en_texto": citas, "seconds": time.time() - start_time}
 
-        # Sequential Chapter Generation Management
-        'chapter_sequence': [], 'current_chapter_index': 0, 'previous_context': "",
-        'chapters_completed': [], 'book_complete': False
-    }
+def citation_index():
+    """extract_citation_index of the current compendio, kept in session state until the compendio changes."""
+    digest = hashlib.sha256(st.session_state.compendio_md.encode("utf-8")).hexdigest()
+    index = st.session_state.get('citation_index')
+    if not index or index["sha256"] != digest:
+        index = {"sha256": digest, **extract_citation_index(st.session_state.compendio_md)}
+        st.session_state.citation_index = index
+    return index
 
-    for key, value in defaults.items():
-        if key not in st.session_state:
-            st.session_state[key] = value
+def local_referencias_node():
+    """'local' step of the mapping_referencias node: the bibliography found by extract_citation_index, if any."""
+    if "mapping_referencias" not in CITATION_EXTRACTION_MODES[st.session_state.get('citation_extraction', 'off')]:
+        return None
+    index = citation_index()
+    if not index["referencias"]:
+        st.toast("No bibliography section found locally; using the mapping_referencias app.", icon="ℹ️")
+        return None
+    st.toast(f"Found {len(index['referencias'])} bibliography entries locally in {index['seconds'] * 1000:.0f} ms.")
+    return {"mapeoReferencias": {"referencias": index["referencias"]}}
 
-def clear_all_session_data():
-    """Resets the entire pipeline by clearing relevant session state keys."""
-    keys_to_clear = [key for key in st.session_state.keys() if key.startswith((
-        'stage_', 'compendio_', 'project_', 'mapping_', 'skeleton', 'generated_', 
-        'final_', 'topic_', 'reference_', 'page_', 'subtemas_', 'uploaded_', 
-        'chapter_', 'current_', 'previous_', 'book_'))]
-    
-    for key in keys_to_clear:
-        del st.session_state[key]
-    
-    st.success("All pipeline data has been cleared. Please refresh the page to start over.")
-    time.sleep(2)
-    st.rerun()
+def local_citas_node():
+    """
+    'local' step of the mapping_citas node: the in-text citations found by extract_citation_index, linked to
+    whichever Step 2.1 references are current (matched by author/year key if they came from the app).
+    """
+    if "mapping_citas" not in CITATION_EXTRACTION_MODES[st.session_state.get('citation_extraction', 'off')]:
+        return None
+    index = citation_index()
+    if not index["citas_en_texto"]:
+        st.toast("No in-text citations found locally; using the mapping_citas app.", icon="ℹ️")
+        return None
+    ids_by_key = {}
+    for ref_id, entry in st.session_state.mapping_referencias.indexes()["references"].items():
+        # References from the app have no key, so it's worked out from their longest text
+        key = entry.get("clave") or reference_key(max((value for value in entry.values() if isinstance(value, str) and value != ref_id), key=len, default=""))
+        if key:
+            ids_by_key.setdefault(key, ref_id)
+    citas = [{**cita, "referencia": ids_by_key.get(cita["clave"])} for cita in index["citas_en_texto"]]
+    linked = sum(1 for cita in citas if cita["referencia"])
+    st.toast(f"Found {len(citas)} in-text citations locally ({linked} linked to a reference) in {index['seconds'] * 1000:.0f} ms.")
+    return {"mapeoCitas": {"citas_en_texto": citas}}
 
-# --- FILE UPLOAD HELPERS ---
+# --- MAPPING STORE ---
 
-def upload_to_0x0(file):
-    """Uploads a file to 0x0.st."""
-    try:
-        file.seek(0)
-        files = {"file": (file.name, file, file.type)}
-        response = requests.post("https://0x0.st", files=files, timeout=60)
-        if response.status_code == 200 and response.text.strip().startswith("https://"):
-            return response.text.strip()
-    except Exception as e:
-        st.toast(f"Error with 0x0.st: {e}", icon="🔥")
-    return None
+class MappingStore:
+    """
+    A Stage 2 mapping as kept in session state. Later stages send it to Wordware as JSON, count its
+    citations and pick out a chapter's references on every rerun, so the serialized text and the indexes
+    are worked out once, on first use, and kept until the mapping is replaced. Never modify 'value' in place.
+    """
 
-def upload_to_catbox(file):
-    """Uploads a file to catbox.moe."""
-    try:
-        file.seek(0)
-        files = {"fileToUpload": (file.name, file, file.type)}
-        data = {"reqtype": "fileupload"}
-        response = requests.post("https://catbox.moe/user/api.php", files=files, data=data, timeout=60)
-        if response.status_code == 200 and response.text.strip().startswith("https://"):
-            return response.text.strip()
-    except Exception as e:
-        st.toast(f"Error with catbox.moe: {e}", icon="🔥")
-    return None
+    def __init__(self, value=None):
+        self.value = value if value is not None else ""  # as the app returned it, so its JSON is unchanged
+        self._json = None
+        self._output = None
+        self._output_json = None
+        self._indexes = None
+        self._chapter_views = {}
 
-def upload_to_tmpfiles(file):
-    """Uploads a file to tmpfiles.org."""
-    try:
-        file.seek(0)
-        files = {"file": (file.name, file, file.type)}
-        response = requests.post("https://tmpfiles.org/api/v1/upload", files=files, timeout=60)
-        if response.status_code == 200:
-            data = response.json()
-            url = data.get("data", {}).get("url", "")
-            if url:
-                return url.replace("https://tmpfiles.org/", "https://tmpfiles.org/dl/")
-    except Exception as e:
-        st.toast(f"Error with tmpfiles.org: {e}", icon="🔥")
-    return None
+    def __bool__(self):
+        return bool(self.value)
 
-def upload_to_fileio(file):
-    """Uploads a file to file.io."""
-    try:
-        file.seek(0)
-        files = {"file": (file.name, file, file.type)}
-        response = requests.post("https://file.io", files=files, timeout=60)
-        if response.status_code == 200:
-            data = response.json()
-            return data.get("link", "")
-    except Exception as e:
-        st.toast(f"Error with file.io: {e}", icon="🔥")
-    return None
+    def json(self):
+        """The mapping as it's sent to Wordware apps."""
+        if self._json is None:
+            self._json = json.dumps(self.value)
+        return self._json
 
-def upload_file_with_fallback(file):
-    """Tries multiple upload services until one succeeds."""
-    services = [upload_to_0x0, upload_to_catbox, upload_to_tmpfiles, upload_to_fileio]
-    for service in services:
-        service_name = service.__name__.replace('upload_to_', '').replace('_', ' ').title()
-        with st.spinner(f"Uploading via {service_name}..."):
-            url = service(file)
-            if url:
-                st.toast(f"Successfully uploaded via {service_name}!", icon="✅")
-                return url
-    st.error("All file upload services failed. Please check your network or try again later.")
-    return None
+    def output(self):
+        """For the combined mapping, mapping_logic's Merger.output (parsed if it came as text); otherwise the mapping."""
+        if self._output is None:
+            output = self.value.get('Merger', {}).get('output', self.value) if isinstance(self.value, dict) else self.value
+            self._output = parse_mapping(output)
+        return self._output
 
+    def output_json(self):
+        """Merger.output as it's sent to chapter_creator."""
+        if self._output_json is None:
+            output = self.value.get('Merger', {}).get('output', self.value) if isinstance(self.value, dict) else self.value
+            self._output_json = json.dumps(output)
+        return self._output_json
 
+    def indexes(self):
+        """
+        {"references": REF id -> entry, "tables": TAB id -> entry, "citations": the in-text citation entries,
+        "citations_by_ref": REF id -> the citations mentioning it}, from one walk over the mapping.
+        """
+        if self._indexes is None:
+            output = self.output()
+            ref_pattern = re.compile(r"\bREF-\d+\b")
+            tab_pattern = re.compile(r"\bTAB-\d+\b")
+            # In a combined mapping only the referencias and tablas parts define ids; citations just mention them
+            merged = isinstance(output, dict) and all(part in output for part in MERGED_MAPPING_PARTS)
+            references = {}
+            for entry in mapping_entries(output['referencias'] if merged else output):
+                ref_id = entry_id(entry, ref_pattern)
+                if ref_id:
+                    references.setdefault(ref_id, entry)
+            tables = {}
+            for entry in mapping_entries(output['tablas'] if merged else output):
+                tab_id = entry_id(entry, tab_pattern)
+                if tab_id:
+                    tables.setdefault(tab_id, entry)
+            citations = []
+            if isinstance(output, dict):
+                citas = output.get('citas', output)
+                citations = citas.get('citas_en_texto', []) if isinstance(citas, dict) else []
+            citations_by_ref = collections.defaultdict(list)
+            for citation in citations:
+                for ref_id in dict.fromkeys(ref_id for text in mapping_strings(citation) for ref_id in ref_pattern.findall(text)):
+                    citations_by_ref[ref_id].append(citation)
+            self._indexes = {"references": references, "tables": tables, "citations": citations, "citations_by_ref": dict(citations_by_ref)}
+        return self._indexes
 
-# --- API CALLER & STREAMING ---
+    def citation_count(self):
+        return len(self.indexes()["citations"])
+
+    def chapter_view_json(self, ids):
+        """
+        JSON of the part of a combined mapping one chapter needs: the given REF ids with their citations, and the
+        given TAB ids (every table if none are given), in the Merger.output shape. None if any REF id isn't in the mapping.
+        """
+        ids = tuple(dict.fromkeys(ids))
+        if ids not in self._chapter_views:
+            indexes = self.indexes()
+            ref_ids = [mapping_id for mapping_id in ids if mapping_id.startswith("REF-")]
+            if not ref_ids or any(ref_id not in indexes["references"] for ref_id in ref_ids):
+                self._chapter_views[ids] = None
+            else:
+                # Citations stay in document order
+                cited = {id(citation) for ref_id in ref_ids for citation in indexes["citations_by_ref"].get(ref_id, [])}
+                self._chapter_views[ids] = json.dumps({
+                    "referencias": [indexes["references"][ref_id] for ref_id in ref_ids],
+                    "citas": {"citas_en_texto": [citation for citation in indexes["citations"] if id(citation) in cited]},
+                    "tablas": [indexes["tables"][tab_id] for tab_id in ids if tab_id in indexes["tables"]]
+                    if any(mapping_id.startswith("TAB-") for mapping_id in ids) else list(indexes["tables"].values())
+                })
+        return self._chapter_views[ids]
+
+# --- PIPELINE ---
 
-def process_wordware_api(app_id, inputs, stream_container=None):
+# Stage 2 nodes in run order
+STAGE_2_NODES = ["mapping_referencias", "mapping_citas", "mapping_tablas", "mapping_combined"]
+
+def mapping_node_inputs(**mappings):
     """
-    Calls a Wordware API endpoint, handles streaming responses, and returns the final output.
-    If a stream_container is provided, it writes chunks to it in real-time.
+    inputs function for a Stage 2 mapping node: the compendio and brief plus the named earlier mappings
+    as JSON. In chunked mode it's one set of inputs per compendio section (see mapping_sections).
     """
-    url = f"{API_BASE_URL}/{app_id}/run"
-    headers = {"Authorization": f"Bearer {API_KEY}"}
-    payload = {"inputs": inputs}
-    
-    try:
-        response = requests.post(url, json=payload, headers=headers, stream=True, timeout=1600) #increased timeout time because of 2.3 mapping.
-        response.raise_for_status()
+    def inputs():
+        shared = {"projectBrief": st.session_state.project_brief_md}
+        shared.update({name: st.session_state[key].json() for name, key in mappings.items()})
+        sections = mapping_sections()
+        if sections is None:
+            return {"compendio": st.session_state.compendio_md, **shared}
+        return [{"compendio": section, **shared} for section in sections]
+    return inputs
 
-        final_output = None
-        full_response_text = ""
-        
-        # Use a generator function for streaming to st.write_stream
-        def stream_generator():
-            nonlocal final_output
-            for line in response.iter_lines():
-                if line:
-                    try:
-                        content = json.loads(line.decode('utf-8'))
-                        value = content.get('value', {})
-                        
-                        if value.get('type') == 'chunk':
-                            yield value.get('value', '')
-                        elif value.get('type') == 'outputs':
-                            final_output = value
-                    except json.JSONDecodeError:
-                        st.warning(f"Could not decode JSON line: {line}")
-        
-        if stream_container:
-            stream_container.write_stream(stream_generator)
+def store_mapping(key, field, id_prefix=None):
+    """
+    store function for a Stage 2 node: keeps just the app's own mapping object, not the whole response.
+    Per-section results from chunked mode are merged, renumbering the id_prefix ids into one sequence.
+    """
+    def store(result):
+        if isinstance(result, list):
+            st.session_state[key] = MappingStore(merge_mapping_sections([section.get(field, section) for section in result], id_prefix))
         else:
-            # If not streaming to UI, just consume the generator to get the final output
-            for _ in stream_generator():
-                pass
-        if final_output:
-            # Assuming the main output is in a key named 'output', 'text', or the first value
-            output_data = final_output.get('values', {})
-            if 'output' in output_data:
-                return output_data['output']
-            elif 'text' in output_data:
-                return output_data['text']
-            # Fallback for varied output structures
-            elif output_data:
-                # first_key = next(iter(output_data))
-                # return output_data[first_key]
-                return output_data
-        return None
+            st.session_state[key] = MappingStore(result.get(field, result) if field else result)
+        return True
+    return store
 
-    except requests.exceptions.RequestException as e:
-        st.error(f"API Request Failed: {e}")
-        try:
-            st.error(f"Error details: {response.json()}")
-        except:
-            st.error(f"Error details: {response.text}")
-        return None
+def pipeline_nodes():
+    """
+    The book pipeline as a DAG of node name -> spec, rebuilt on every call since Stage 4 has a node per chapter.
+    Each node is one Wordware call: 'needs' are the nodes whose outputs its inputs are built from, 'inputs'
+    builds them from session state, and 'store' saves the result there (False if it's unusable).
+    If 'inputs' returns a list the node maps the app over it, and 'store' gets the list of results.
+    A node with a 'local' function runs that first, and only calls its app if it returns None.
+    The Stage 1 nodes have no 'app'; they are the document parses, which render_stage_1 runs and marks complete.
+    """
+    nodes = {
+        "compendio": {"label": "Compendio", "needs": []},
+        "project_brief": {"label": "Project Brief", "needs": []},
+        "mapping_referencias": {
+            "label": "Step 2.1: Extracting Bibliography References",
+            "needs": ["compendio", "project_brief"],
+            "app": "mapping_referencias",
+            "local": local_referencias_node,
+            "inputs": mapping_node_inputs(),
+            "store": store_mapping("mapping_referencias", "mapeoReferencias", "REF"),
+        },
+        "mapping_citas": {
+            "label": "Step 2.2: Mapping In-Text Citations",
+            "needs": ["compendio", "project_brief", "mapping_referencias"],
+            "app": "mapping_citas",
+            "local": local_citas_node,
+            "inputs": mapping_node_inputs(**{"2.1Mapping_Referencias": "mapping_referencias"}),
+            "store": store_mapping("mapping_citas", "mapeoCitas"),
+        },
+        "mapping_tablas": {
+            "label": "Step 2.3: Mapping Tables and Figures",
+            "needs": ["compendio", "project_brief", "mapping_referencias", "mapping_citas"],
+            "app": "mapping_tablas",
+            "inputs": mapping_node_inputs(**{"2.1Mapping_Referencias": "mapping_referencias", "2.2Mapping_citas": "mapping_citas"}),
+            "store": store_mapping("mapping_tablas", "mapeoTablas", "TAB"),
+        },
+        "mapping_combined": {
+            "label": "Step 2.4: Combining All Mappings",
+            "needs": ["mapping_referencias", "mapping_citas", "mapping_tablas"],
+            "app": "mapping_logic",
+            "local": merge_mappings_node,
+            "inputs": lambda: {
+                "mapeoCitas": st.session_state.mapping_citas.json(),
+                "mapeoReferencias": st.session_state.mapping_referencias.json(),
+                "mapeoTablas": st.session_state.mapping_tablas.json()
+            },
+            "store": store_mapping("mapping_combined", None),
+        },
+        "skeleton": {
+            "label": "Generating the ebook skeleton",
+            "needs": ["compendio", "project_brief", "mapping_combined"],
+            "app": "theme_selector",
+            "inputs": build_skeleton_inputs,
+            "store": apply_skeleton,
+        },
+    }
+    chapter_nodes = [f"chapter:{chapter_id}" for chapter_id in st.session_state.chapter_sequence]
+    for chapter_id, name in zip(st.session_state.chapter_sequence, chapter_nodes):
+        nodes[name] = {
+            "label": f"Generando {chapter_id}",
+            "needs": ["compendio", "mapping_combined", "skeleton"],
+            "app": "chapter_creator",
+            "inputs": lambda chapter_id=chapter_id: build_chapter_inputs(chapter_id),
+            "store": lambda result, chapter_id=chapter_id: store_generated_chapter(chapter_id, result),
+        }
+    nodes["final_ebook"] = {
+        "label": "Assembling the final ebook",
+        "needs": ["skeleton"] + chapter_nodes,
+        "app": "table_generator",
+        "inputs": build_assembly_inputs,
+        "store": store_final_ebook,
+    }
+    return nodes
+
+def pipeline_order(nodes, targets):
+    """The targets and everything they depend on, dependencies first."""
+    order = []
+
+    def visit(name):
+        if name in order:
+            return
+        for need in nodes[name]["needs"]:
+            visit(need)
+        order.append(name)
+
+    for name in targets:
+        visit(name)
+    return order
+
+def complete_pipeline_node(name, nodes=None):
+    """Records that a node's output is current; completed nodes built from its previous output become 'stale'."""
+    nodes = nodes or pipeline_nodes()
+    status = st.session_state.pipeline_status
+    status[name] = 'completed'
+    changed = [name]
+    seen = {name}
+    while changed:
+        source = changed.pop()
+        for dependent, node in nodes.items():
+            if source in node["needs"] and dependent not in seen and status.get(dependent) in ('completed', 'stale'):
+                status[dependent] = 'stale'
+                changed.append(dependent)
+                seen.add(dependent)
+
+def run_pipeline(targets, rerun=(), use_cache=True, max_concurrency=None, priority="interactive"):
+    """
+    Runs the target nodes unless their output is current, resuming after whatever already completed.
+    Dependencies that have never completed run first; stale ones are used as they are, so running one stage
+    never regenerates another behind the user's back. Nodes run in waves of everything whose dependencies
+    are done, each wave concurrently. Nodes in rerun run even if current, with use_cache for their calls.
+    Returns the nodes that failed or couldn't run, dependencies first ([] on success).
+    """
+    nodes = pipeline_nodes()
+    status = st.session_state.pipeline_status
+    order = pipeline_order(nodes, targets)
+    attempted = set()
+    # Nodes that failed in this run; one that completed before keeps its status, but still counts as failed here
+    failed = set()
+
+    def satisfied(name):
+        if name in failed or (name in rerun and name not in attempted):
+            return False
+        return status.get(name) == 'completed' or (status.get(name) == 'stale' and name not in targets)
+
+    def finish(name, result):
+        attempted.add(name)
+        if result and nodes[name]["store"](result):
+            complete_pipeline_node(name, nodes)
+            st.toast(f"{nodes[name]['label']}: done.", icon="✅")
+            return
+        failed.add(name)
+        if name not in status:
+            # A node that failed to re-run keeps its previous output and status
+            status[name] = 'error'
+
+    while True:
+        pending = [name for name in order if not satisfied(name)]
+        runnable = [
+            name for name in pending
+            if "app" in nodes[name] and name not in attempted and all(satisfied(need) for need in nodes[name]["needs"])
+        ]
+        if not runnable:
+            # Finished, or what's left waits on Stage 1 or on a node that failed
+            return pending
+
+        calls = []
+        call_nodes = []
+        call_counts = []
+        for name in runnable:
+            if "local" in nodes[name]:
+                result = nodes[name]["local"]()
+                if result is not None:
+                    finish(name, result)
+                    continue
+            inputs = nodes[name]["inputs"]()
+            mapped = isinstance(inputs, list)
+            label = f"🔄 {nodes[name]['label']} ({len(inputs)} sections)..." if mapped else f"🔄 {nodes[name]['label']}..."
+            with st.expander(label, expanded=len(runnable) == 1):
+                for item in (inputs if mapped else [inputs]):
+                    calls.append({
+                        "app_id": APP_IDS[nodes[name]["app"]],
+                        "inputs": item,
+                        "container": st.empty(),
+                        "use_cache": use_cache or name not in rerun
+                    })
+            call_nodes.append(name)
+            call_counts.append(len(inputs) if mapped else None)
+        results = process_wordware_batch(calls, max_concurrency=max_concurrency, priority=priority)
+        position = 0
+        for name, count in zip(call_nodes, call_counts):
+            if count is None:
+                result = results[position]
+                position += 1
+            else:
+                # A mapped node only succeeds if every one of its calls did
+                result = results[position:position + count]
+                result = result if all(result) else None
+                position += count
+            finish(name, result)
+
+def render_pipeline_status(names):
+    """One status line per node, so a resumed stage shows which steps it will skip."""
+    nodes = pipeline_nodes()
+    icons = {'completed': "✅", 'stale': "⚠️ (inputs changed)", 'error': "❌"}
+    for name in names:
+        st.caption(f"{icons.get(st.session_state.pipeline_status.get(name), '⚪')} {nodes[name]['label']}")
 
 # --- UI RENDERING FUNCTIONS ---
 
@@ -341,6 +2914,98 @@ def render_sidebar():
             type="primary" if st.session_state.current_stage == 5 else "secondary"
         )
         
+        st.divider()
+        st.button(
+            "📈 Call Metrics",
+            on_click=lambda: st.session_state.update(current_stage='metrics'),
+            use_container_width=True,
+            disabled=is_generating,
+            type="primary" if st.session_state.current_stage == 'metrics' else "secondary"
+        )
+        with st.expander("🔌 API Connection Pool"):
+            pool_stats = get_pool_stats()
+            col1, col2 = st.columns(2)
+            col1.metric("Pool Hits", pool_stats["hits"], help=f"Avg. {pool_stats['avg_hit_latency']:.2f}s to first response")
+            col2.metric("Pool Misses", pool_stats["misses"], help=f"Avg. {pool_stats['avg_miss_latency']:.2f}s to first response")
+            if pool_stats["hits"] and pool_stats["misses"]:
+                saved = pool_stats["avg_miss_latency"] - pool_stats["avg_hit_latency"]
+                st.caption(f"Connection reuse saves ~{saved:.2f}s per call.")
+
+        if st.session_state.get('partial_outputs'):
+            with st.expander(f"🧩 Salvaged Partial Outputs ({len(st.session_state.partial_outputs)})"):
+                st.caption("Text received from runs that were interrupted before finishing.")
+                for app_name, partial in st.session_state.partial_outputs.items():
+                    st.download_button(
+                        label=f"{app_name} · {len(partial['text'])} chars · {time.strftime('%H:%M', time.localtime(partial['time']))}",
+                        data=partial['text'].encode('utf-8'),
+                        file_name=f"{app_name}_partial.md",
+                        mime="text/markdown",
+                        key=f"partial_download_{app_name}",
+                        use_container_width=True
+                    )
+
+        with st.expander("🚦 API Queue"):
+            queue_rows = []
+            for app_id, scheduler in get_wordware_schedulers().items():
+                snapshot = scheduler.snapshot()
+                if snapshot["running"] or snapshot["queued"] or snapshot["avg_wait"]:
+                    queue_rows.append((APP_NAMES.get(app_id, app_id), snapshot))
+            if not queue_rows:
+                st.caption("No Wordware calls queued or running.")
+            for app_name, snapshot in queue_rows:
+                st.caption(
+                    f"**{app_name}** · {snapshot['running']}/{snapshot['concurrency']} running · {snapshot['queued']} queued · "
+                    f"wait avg {snapshot['avg_wait']:.1f}s / max {snapshot['max_wait']:.1f}s"
+                )
+
+        with st.expander("📺 Stream Rendering"):
+            st.toggle(
+                "Live text rendering",
+                value=True,
+                key='live_stream_rendering',
+                help="Turn off to show only progress counters while text is generated; the result appears when the call finishes."
+            )
+            st.caption(f"Updates are batched every {STREAM_FLUSH_INTERVAL * 1000:.0f} ms or {STREAM_FLUSH_BYTES // 1024} KB.")
+            for stats in reversed(st.session_state.get('render_stats', [])[-5:]):
+                st.caption(
+                    f"**{stats['app']}** · {stats['chunks_per_second']:.0f} chunks/s · "
+                    f"{stats['chunks']} chunks in {stats['flushes']} updates · render {stats['render_overhead']:.0%}"
+                )
+
+        with st.expander("⚡ Response Cache"):
+            st.toggle("Reuse cached Wordware results", value=True, key='cache_enabled')
+            st.multiselect(
+                "Always run fresh",
+                options=list(APP_IDS.keys()),
+                default=WORDWARE_CACHE_BYPASS_APPS,
+                key='cache_bypass_apps',
+                help="Apps that skip the cache, e.g. when you want new chapter text for the same inputs."
+            )
+            st.slider("Replay speed (chunks/s, 0 = instant)", 0, 500, 0, step=50, key='cache_replay_speed')
+            cache_entries = list_disk_cache(WORDWARE_CACHE_DIR)
+            cache_size_mb = sum(size for _, size, _ in cache_entries) / (1024 * 1024)
+            st.caption(f"{len(cache_entries)} cached runs · {cache_size_mb:.1f} / {WORDWARE_CACHE_MAX_BYTES // (1024 * 1024)} MB")
+            parse_entries = list_disk_cache(PARSE_CACHE_DIR)
+            parse_size_mb = sum(size for _, size, _ in parse_entries) / (1024 * 1024)
+            st.caption(f"{len(parse_entries)} cached PDF parses · {parse_size_mb:.1f} / {PARSE_CACHE_MAX_BYTES // (1024 * 1024)} MB")
+            if st.button("Clear Cache", use_container_width=True, disabled=not (cache_entries or parse_entries)):
+                clear_disk_cache(WORDWARE_CACHE_DIR)
+                clear_disk_cache(PARSE_CACHE_DIR)
+                st.rerun()
+
+        with st.expander("🔗 Hosted Inputs"):
+            st.toggle(
+                "Host large inputs",
+                value=False,
+                key='host_large_inputs',
+                help=f"Uploads the compendio, skeleton and mapping to a file host once and passes them to chapter_creator by URL "
+                     f"when they're over {HOSTED_INPUT_MIN_BYTES // 1024} KB. The chapter_creator app must accept file inputs for these."
+            )
+            for file_name, hosted in st.session_state.uploaded_files.items():
+                if "expires" in hosted:
+                    remaining = max(0, hosted["expires"] - time.time())
+                    st.caption(f"{file_name} · {hosted['size'] / (1024 * 1024):.1f} MB on {hosted['service']} · expires in {remaining / 3600:.0f} h")
+
         st.divider()
         st.warning("Clearing data will reset the entire process and cannot be undone.")
         if st.button("🔄 Clear All Data & Restart", use_container_width=True, type="primary", disabled=is_generating):
@@ -429,93 +3094,88 @@ def render_stage_1():
 
     compendio_file = st.file_uploader("Upload Compendio PDF (Required)", type="pdf", key="compendio_uploader")
     project_brief_file = st.file_uploader("Upload Project Brief PDF (Optional)", type="pdf", key="project_brief_uploader")
+    parse_mode = st.radio(
+        "Parser",
+        options=list(PARSE_MODES.keys()),
+        format_func=PARSE_MODE_LABELS.get,
+        key="parse_mode",
+        horizontal=True,
+        help="The fast local parser extracts rough markdown in seconds, without tables from scanned pages. "
+             "'Local first' lets you continue right away and swaps in the LlamaParse text when it's ready. "
+             "The LlamaParse vs Wordware modes run both at once, so a slow or failing provider doesn't hold up Stage 1."
+    )
+    force_reparse = st.checkbox(
+        "Force re-parse",
+        key="force_reparse",
+        help="Ignore cached parser results for these PDFs and parse them again."
+    )
 
     if st.button("Process Source Documents", disabled=(not compendio_file)):
         st.session_state.stage_1_status = 'in_progress'
-        
-        # Import LlamaParse here to avoid issues if not used
+        cancel_background_parses()
+        engine, background_engine = PARSE_MODES[parse_mode]
+        # Each upload is spooled to disk once and shared by every parse of it
+        documents = {
+            # Agentic-equivalent settings
+            "compendio": (spool_upload(compendio_file), "Extract all text content including ALL tables. Preserve complete table structure with proper markdown formatting. Include all citations, references, and footnotes.")
+        }
+        if project_brief_file:
+            documents["project_brief"] = (spool_upload(project_brief_file), "Extract all text content including tables and references.")
+
         try:
-            from llama_parse import LlamaParse
-            import nest_asyncio
-            nest_asyncio.apply()
-        except ImportError:
-            st.error("LlamaParse not installed. Please run: pip install llama-parse nest-asyncio")
-            st.session_state.stage_1_status = 'error'
-            return
-        
-        # Process Compendio
-        with st.spinner(f"Processing {compendio_file.name} with LlamaParse..."):
-            try:
-                # Initialize parser with Agentic-equivalent settings
-                parser = LlamaParse(
-                    api_key=st.secrets["LLAMAPARSE_API_KEY"],
-                    result_type="markdown",
-                    parsing_instruction="Extract all text content including ALL tables. Preserve complete table structure with proper markdown formatting. Include all citations, references, and footnotes.",
-                    verbose=True,
-                    invalidate_cache=True
-                )
-                
-                # Save file temporarily
-                import tempfile
-                import os
-                
-                with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-                    tmp_file.write(compendio_file.getvalue())
-                    tmp_file_path = tmp_file.name
-                
-                # Parse the file
-                documents = parser.load_data(tmp_file_path)
-                
-                # Clean up temp file
-                os.unlink(tmp_file_path)
-                
-                # Combine all pages into single markdown
-                compendio_md = "\n\n".join([doc.text for doc in documents])
-                
-                if not compendio_md:
-                    raise ValueError("No content extracted from Compendio")
-                    
-                st.session_state.compendio_md = compendio_md
-                st.success(f"✅ Compendio processed: {len(compendio_md)} characters extracted")
-                
-            except Exception as e:
+            # Parse both documents at the same time; Stage 1 takes as long as the slower one
+            parse_jobs = {
+                label: submit_parse_job(pdf, label, instruction, engine=engine, use_cache=not force_reparse)
+                for label, (pdf, instruction) in documents.items()
+            }
+            with st.spinner(f"Processing source documents with {PARSE_MODE_LABELS[engine]}..."):
+                parse_results = wait_for_parse_jobs(parse_jobs, required=("compendio",), allow_partial=True)
+            st.session_state.document_sources = {label: parse_jobs[label]["store"].source for label, result in parse_results.items() if result and not isinstance(result, Exception)}
+
+            # Compendio is required
+            compendio_md = parse_results["compendio"]
+            if isinstance(compendio_md, CancelledError):
+                st.session_state.stage_1_status = 'pending'
+                st.warning("Compendio processing was cancelled.")
+                return
+            if isinstance(compendio_md, Exception):
                 st.session_state.stage_1_status = 'error'
-                st.error(f"Failed to process Compendio: {str(e)}")
+                st.error(f"Failed to process Compendio: {str(compendio_md)}")
                 return
-        
-        # Process Project Brief if provided
-        st.session_state.project_brief_md = ""
-        if project_brief_file:
-            with st.spinner(f"Processing {project_brief_file.name} with LlamaParse..."):
-                try:
-                    # Use same parser settings
-                    parser_brief = LlamaParse(
-                        api_key=st.secrets["LLAMAPARSE_API_KEY"],
-                        result_type="markdown",
-                        parsing_instruction="Extract all text content including tables and references.",
-                        verbose=True,
-                        invalidate_cache=True
-                    )
-                    
-                    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-                        tmp_file.write(project_brief_file.getvalue())
-                        tmp_file_path = tmp_file.name
-                    
-                    documents_brief = parser_brief.load_data(tmp_file_path)
-                    os.unlink(tmp_file_path)
-                    
-                    brief_md = "\n\n".join([doc.text for doc in documents_brief])
-                    
-                    if brief_md:
-                        st.session_state.project_brief_md = brief_md
-                        st.success(f"✅ Project Brief processed: {len(brief_md)} characters extracted")
-                    else:
-                        st.warning("Project Brief processed but no content extracted, continuing without it.")
-                        
-                except Exception as e:
-                    st.warning(f"Could not process Project Brief: {str(e)}. Continuing with Compendio only.")
+            if not compendio_md:
+                st.session_state.stage_1_status = 'error'
+                st.error("Failed to process Compendio: No content extracted from Compendio")
+                return
+            store_document_markdown("compendio", compendio_md)
+            st.success(f"✅ Compendio processed: {len(compendio_md)} characters extracted")
+
+            # Project Brief is optional, so its failures only warn
+            st.session_state.project_brief_md = ""
+            if project_brief_file:
+                brief_md = parse_results["project_brief"]
+                if isinstance(brief_md, CancelledError):
+                    st.warning("Project Brief processing was cancelled. Continuing with Compendio only.")
+                elif isinstance(brief_md, Exception):
+                    st.warning(f"Could not process Project Brief: {str(brief_md)}. Continuing with Compendio only.")
+                elif brief_md:
+                    store_document_markdown("project_brief", brief_md)
+                    st.success(f"✅ Project Brief processed: {len(brief_md)} characters extracted")
+                else:
+                    st.warning("Project Brief processed but no content extracted, continuing without it.")
+
+            if background_engine:
+                st.session_state.background_parses = {
+                    label: submit_parse_job(pdf, label, instruction, engine=background_engine, use_cache=not force_reparse, background=True)
+                    for label, (pdf, instruction) in documents.items() if label in st.session_state.document_sources
+                }
+        finally:
+            # The jobs hold their own references to the spooled files
+            for spool, _ in documents.values():
+                release_spooled_upload(spool)
         
         # Mark stage as complete
+        complete_pipeline_node("compendio")
+        complete_pipeline_node("project_brief")
         st.session_state.stage_1_status = 'completed'
         st.success("Stage 1 Completed! Documents processed successfully.")
         st.rerun()
@@ -523,6 +3183,15 @@ def render_stage_1():
     # Display results if stage is completed
     if st.session_state.stage_1_status == 'completed':
         st.success("✅ Stage 1 is complete. You can now proceed to Stage 2.")
+        drafts = [label for label, source in st.session_state.document_sources.items() if source == "local"]
+        if drafts:
+            st.info(f"Using the fast local draft for: {', '.join(drafts)}. Tables and layout may be rough.")
+        partial = [label for label, source in st.session_state.document_sources.items() if source == "partial"]
+        if partial:
+            st.info(f"Still parsing: {', '.join(partial)}. Later stages use the complete sections parsed so far until it finishes.")
+        for label, report in st.session_state.document_normalization.items():
+            if st.session_state.get(f"{label}_md"):
+                st.caption(format_normalization_report(label.replace("_", " ").title(), report))
         
         # Show Compendio content
         with st.expander("View Processed Compendio Markdown"):
@@ -550,83 +3219,62 @@ def render_stage_2():
     st.header("Stage 2: Reference & Citation Mapping")
     st.markdown("This stage automatically extracts and maps all references, citations, and tables from the processed content. Click the button below to begin.")
 
-    if st.button("Start Reference Mapping", disabled=(st.session_state.stage_1_status != 'completed')):
-        st.session_state.stage_2_status = 'in_progress'
-            # Run 2.1 Mapping_Referencias
-        with st.spinner("Step 2.1: Extracting Bibliography References..."):
-            inputs_2_1 = {"compendio": st.session_state.compendio_md, "projectBrief": st.session_state.project_brief_md}
-            result = process_wordware_api(APP_IDS["mapping_referencias"], inputs_2_1)
-            if result:
-                # Extract just the mapeoReferencias object, not the whole response
-                st.session_state.mapping_referencias = result.get("mapeoReferencias", result)
-                st.session_state.stage_2_1_status = 'completed'
-                st.toast("Step 2.1: References extracted.", icon="✅")
-            else:
-                st.session_state.stage_2_status = 'error'
-                st.error("Failed at Step 2.1. Cannot proceed.")
-                return
-
-        # Run 2.2 Mapping_Citas
-        with st.spinner("Step 2.2: Mapping In-Text Citations..."):
-            inputs_2_2 = {
-                "compendio": st.session_state.compendio_md, 
-                "projectBrief": st.session_state.project_brief_md,
-                "2.1Mapping_Referencias": json.dumps(st.session_state.mapping_referencias)
-            }
-            result = process_wordware_api(APP_IDS["mapping_citas"], inputs_2_2)
-            if result:
-                # Extract just the mapeoCitas object
-                st.session_state.mapping_citas = result.get("mapeoCitas", result)
-                st.session_state.stage_2_2_status = 'completed'
-                st.toast("Step 2.2: Citations mapped.", icon="✅")
-            else:
-                st.session_state.stage_2_status = 'error'
-                st.error("Failed at Step 2.2. Cannot proceed.")
-                return
-
-        # Run 2.3 Mapping_Tablas
-        with st.spinner("Step 2.3: Mapping Tables and Figures..."):
-            inputs_2_3 = {
-                "compendio": st.session_state.compendio_md,
-                "projectBrief": st.session_state.project_brief_md,
-                "2.1Mapping_Referencias": json.dumps(st.session_state.mapping_referencias),
-                "2.2Mapping_citas": json.dumps(st.session_state.mapping_citas)  # Fixed capitalization
-            }
-            result = process_wordware_api(APP_IDS["mapping_tablas"], inputs_2_3)
-            if result:
-                # Extract just the mapeoTablas object
-                st.session_state.mapping_tablas = result.get("mapeoTablas", result)
-                st.session_state.stage_2_3_status = 'completed'
-                st.toast("Step 2.3: Tables mapped.", icon="✅")
-            else:
-                st.session_state.stage_2_status = 'error'
-                st.error("Failed at Step 2.3. Cannot proceed.")
-                return
+    # Steps that already completed are skipped, so a failed run resumes where it stopped
+    status = st.session_state.pipeline_status
+    completed = [name for name in STAGE_2_NODES if status.get(name) == 'completed']
+    stale = [name for name in STAGE_2_NODES if status.get(name) == 'stale']
+    if len(completed) == len(STAGE_2_NODES):
+        button_label, rerun = "Re-run Reference Mapping", STAGE_2_NODES
+    elif stale:
+        button_label, rerun = "Update Reference Mapping", ()
+        st.warning("The processed documents changed since these mappings were built. Update them to use the current text.")
+    elif completed:
+        button_label, rerun = "Resume Reference Mapping", ()
+    else:
+        button_label, rerun = "Start Reference Mapping", ()
+    if completed or stale or any(status.get(name) == 'error' for name in STAGE_2_NODES):
+        render_pipeline_status(STAGE_2_NODES)
 
-            # Run 2.4 MappingLogic
-            with st.spinner("Step 2.4: Combining All Mappings..."):
-                inputs_2_4 = {
-                    "mapeoCitas": json.dumps(st.session_state.mapping_citas),
-                    "mapeoReferencias": json.dumps(st.session_state.mapping_referencias),
-                    "mapeoTablas": json.dumps(st.session_state.mapping_tablas)
-                }
-                result = process_wordware_api(APP_IDS["mapping_logic"], inputs_2_4)
-                if result:
-                    st.session_state.mapping_combined = result
-                    st.session_state.stage_2_4_status = 'completed'
-                    st.session_state.stage_2_status = 'completed'
-                    st.success("Stage 2 Completed! All references, citations, and tables have been mapped.")
-                else:
-                    st.session_state.stage_2_status = 'error'
-                    st.error("Failed at Step 2.4. Could not combine mappings.")
-            st.rerun()
+    st.toggle(
+        "Chunked mapping",
+        key='chunked_mapping',
+        help=f"Maps the compendio in sections of up to {MAPPING_SECTION_CHARS // 1000}k characters, split at headings, "
+             f"with the sections running in parallel, then merges the results and renumbers their REF/TAB ids. "
+             f"Keeps long compendios from timing out."
+    )
+    st.radio(
+        "Local citation extraction",
+        options=list(CITATION_EXTRACTION_MODES.keys()),
+        format_func=CITATION_EXTRACTION_LABELS.get,
+        key='citation_extraction',
+        horizontal=True,
+        help="Finds the bibliography and '(Author, 2019)' citations in the compendio with pattern matching, in "
+             "milliseconds. The hybrid mode passes the local bibliography to the mapping_citas app. "
+             "A step falls back to its app if nothing is found locally."
+    )
+    st.toggle(
+        "Merge mappings locally",
+        key='local_mapping_merge',
+        help="Combines the three mappings in-process for Step 2.4 instead of calling the mapping_logic app, "
+             "which is still used if the local result fails validation."
+    )
+    if st.button(button_label, disabled=(st.session_state.stage_1_status != 'completed')):
+        st.session_state.stage_2_status = 'in_progress'
+        failed = run_pipeline(STAGE_2_NODES, rerun=rerun, use_cache=not rerun)
+        if failed:
+            st.session_state.stage_2_status = 'error'
+            st.error(f"Failed at {pipeline_nodes()[failed[0]]['label']}. The steps that finished are kept, so the next run resumes from there.")
+            return
+        st.session_state.stage_2_status = 'completed'
+        st.success("Stage 2 Completed! All references, citations, and tables have been mapped.")
+        st.rerun()
 
     if st.session_state.stage_2_status == 'completed':
         st.success("✅ Stage 2 is complete. You can now proceed to Stage 3.")
         with st.expander("View Combined Mapping Data (JSON)"):
             # st.json(st.session_state.mapping_combined)
             # Show only Merger output instead of the full response
-            merger_output = st.session_state.mapping_combined.get('Merger', {}).get('output', st.session_state.mapping_combined)
+            merger_output = st.session_state.mapping_combined.output()
             st.json(merger_output)
 
 # ## --- Stage 3: Structure Creation --- that currently works perfectly
@@ -1067,20 +3715,50 @@ def render_stage_2():
 
 ## --- Stage 3: Structure Creation (MODIFIED - Dynamic Reference Slider) ---
 ## --- Stage 3: Structure Creation (MODIFIED - Dynamic Citation Count Slider) ---
+
+# Upper bound for skeletons generated side by side
+MAX_SKELETON_CANDIDATES = 3
+
+def build_skeleton_inputs():
+    """theme_selector inputs from the Stage 3 settings."""
+    return {
+        "compendio": st.session_state.compendio_md,
+        "projectBrief": st.session_state.project_brief_md,
+        "topicInput": st.session_state.topic_input,
+        "referenceCount": st.session_state.reference_count,
+        "MapeoContenido": st.session_state.mapping_combined.json(),
+        "pageCount": st.session_state.page_count,
+        "subtemas": not st.session_state.subtemas_enabled
+    }
+
+def apply_skeleton(result):
+    """Stores a theme_selector result as the skeleton and derives the chapter sequence for Stage 4. Returns False if it has no chapter structure."""
+    st.session_state.skeleton = result
+    
+    # Extract chapter sequence for Stage 4
+    try:
+        structure = result.get('EsqueletoMaestro', {}).get('esqueletoLogica', {}).get('estructura_capitulos', [])
+        chapter_list = [f"capitulo_{i+1}" for i in range(len(structure))]
+        
+        st.session_state.chapter_sequence = chapter_list
+        st.session_state.stage_3_status = 'completed'
+        st.success("Stage 3 Completed! Ebook skeleton generated successfully.")
+        return True
+    except Exception as e:
+        st.session_state.stage_3_status = 'error'
+        st.error(f"Could not parse chapter structure from skeleton: {e}")
+        st.json(result)
+        return False
+
 def render_stage_3():
     st.header("Stage 3: Ebook Structure Creation")
     st.markdown("Define the core parameters for your ebook. The AI will generate a detailed skeleton, including chapter structure, narrative arc, and reference distribution.")
 
     # Extract total citations from Stage 2 mapping for dynamic slider
     try:
-        mapeo_contenido = st.session_state.mapping_combined.get('Merger', {}).get('output', st.session_state.mapping_combined)
-        
-        # If it's a string, parse it
-        if isinstance(mapeo_contenido, str):
-            mapeo_contenido = json.loads(mapeo_contenido)
-        
-        citas = mapeo_contenido.get('citas', {}).get('citas_en_texto', [])
-        total_citations = len(citas) if citas else 50  # Fallback to 50 if empty
+        # Counted once per mapping, not on every rerun
+        citation_count = st.session_state.mapping_combined.citation_count()
+        total_citations = citation_count if citation_count else 50  # Fallback to 50 if empty
     except Exception as e:
         # If anything fails, default to 50
         total_citations = 50
@@ -1121,6 +3799,13 @@ def render_stage_3():
                     key='page_count',
                     help="Estimated page range for the final ebook."
                 )
+            st.number_input(
+                "Skeleton Candidates",
+                min_value=1,
+                max_value=MAX_SKELETON_CANDIDATES,
+                key='skeleton_candidate_count',
+                help="Generate several alternative skeletons in parallel and pick the best one."
+            )
             
             submitted = st.form_submit_button(
                 "Generate Ebook Skeleton", 
@@ -1156,47 +3841,57 @@ def render_stage_3():
 
             # If user confirmed or first time generating
             if st.session_state.get('confirm_regen', True):
+                # A confirmed regeneration should produce a new skeleton, not the cached one
+                is_regeneration = bool(st.session_state.skeleton)
                 st.session_state.stage_3_status = 'in_progress'
                 
                 # Clear confirmation flag
                 if 'confirm_regen' in st.session_state:
                     del st.session_state.confirm_regen
                 
-                inputs = {
-                    "compendio": st.session_state.compendio_md,
-                    "projectBrief": st.session_state.project_brief_md,
-                    "topicInput": st.session_state.topic_input,
-                    "referenceCount": st.session_state.reference_count,
-                    "MapeoContenido": json.dumps(st.session_state.mapping_combined),
-                    "pageCount": st.session_state.page_count,
-                    "subtemas": not st.session_state.subtemas_enabled
-                }
+                candidate_count = st.session_state.skeleton_candidate_count
+                if candidate_count > 1:
+                    st.info(f"Generating {candidate_count} skeleton candidates in parallel... This might take a moment.")
+                    calls = []
+                    for i, tab in enumerate(st.tabs([f"Candidato {i+1}" for i in range(candidate_count)])):
+                        with tab:
+                            # Only the first candidate may come from cache or join a running call; the others must be fresh alternatives
+                            calls.append({"app_id": APP_IDS["theme_selector"], "inputs": build_skeleton_inputs(), "container": st.empty(), "use_cache": i == 0 and not is_regeneration, "single_flight": i == 0})
+                    
+                    candidates = [result for result in process_wordware_batch(calls) if result]
+                    if candidates:
+                        st.session_state.skeleton_candidates = candidates
+                        st.session_state.stage_3_status = 'completed' if st.session_state.skeleton else 'pending'
+                    else:
+                        st.session_state.stage_3_status = 'error'
+                        st.error("Failed to generate ebook skeleton.")
+                    st.rerun()
                 
                 st.info("Generating the ebook skeleton... This might take a moment.")
-                stream_container = st.empty()
-                
-                result = process_wordware_api(APP_IDS["theme_selector"], inputs, stream_container)
                 
-                if result:
-                    st.session_state.skeleton = result
-                    
-                    # Extract chapter sequence for Stage 4
-                    try:
-                        structure = result.get('EsqueletoMaestro', {}).get('esqueletoLogica', {}).get('estructura_capitulos', [])
-                        chapter_list = [f"capitulo_{i+1}" for i in range(len(structure))]
-                        
-                        st.session_state.chapter_sequence = chapter_list
-                        st.session_state.stage_3_status = 'completed'
-                        st.success("Stage 3 Completed! Ebook skeleton generated successfully.")
-                    except Exception as e:
-                        st.session_state.stage_3_status = 'error'
-                        st.error(f"Could not parse chapter structure from skeleton: {e}")
-                        st.json(result)
-                else:
+                # apply_skeleton reports its own errors
+                if run_pipeline(["skeleton"], rerun=["skeleton"], use_cache=not is_regeneration) and st.session_state.stage_3_status != 'error':
                     st.session_state.stage_3_status = 'error'
                     st.error("Failed to generate ebook skeleton.")
                 st.rerun()
 
+    # --- SKELETON CANDIDATE PICKER ---
+    if st.session_state.get('skeleton_candidates') and not st.session_state.edit_mode_stage_3:
+        st.subheader("Elige un Esqueleto")
+        candidates = st.session_state.skeleton_candidates
+        for i, tab in enumerate(st.tabs([f"Candidato {i+1}" for i in range(len(candidates))])):
+            with tab:
+                esqueleto = candidates[i].get('EsqueletoMaestro', {}).get('esqueletoLogica', {})
+                for chapter in esqueleto.get('estructura_capitulos', []):
+                    st.markdown(f"- {chapter}")
+                st.caption(esqueleto.get('arco_narrativo', ''))
+                if st.button("✅ Usar este esqueleto", key=f"use_skeleton_{i}", type="primary", use_container_width=True):
+                    st.session_state.skeleton_candidates = []
+                    if apply_skeleton(candidates[i]):
+                        complete_pipeline_node("skeleton")
+                    st.rerun()
+        st.divider()
+
     # --- DISPLAY GENERATED SKELETON (View Mode) ---
     if st.session_state.stage_3_status == 'completed' and not st.session_state.edit_mode_stage_3:
         st.success("✅ Stage 3 is complete. You can now proceed to Stage 4.")
@@ -1491,6 +4186,9 @@ def render_stage_3():
                 # Rebuild chapter sequence
                 st.session_state.chapter_sequence = [f"capitulo_{i+1}" for i in range(len(edited_chapters))]
                 
+                # Chapters written from the previous skeleton are now out of date
+                complete_pipeline_node("skeleton")
+                
                 # Exit edit mode
                 st.session_state.edit_mode_stage_3 = False
                 
@@ -2382,6 +5080,58 @@ def render_stage_3():
 # # #         st.success("✅ Todos los capítulos generados. Procede a Stage 5.")
 
 ## --- Stage 4: Chapter Creation (ENHANCED - Full Parameter Editing + Auto Arco Narrativo) ---
+
+# How many chapters "Generar Todos" streams at once
+CHAPTER_BATCH_CONCURRENCY = 3
+
+def chapter_mapping_ids(chapter_id):
+    """REF/TAB ids the skeleton assigns a chapter, from its 'Capítulo N: REF-001, TAB-002' line in referenciasMapeo."""
+    chapter_number = st.session_state.chapter_sequence.index(chapter_id) + 1
+    referencias_mapeo = st.session_state.skeleton.get('EsqueletoMaestro', {}).get('esqueletoLogica', {}).get('distribuicion_referencias', {}).get('referenciasMapeo', [])
+    for line in referencias_mapeo:
+        if re.match(rf"\s*Cap[ií]tulo\s+{chapter_number}\s*:", str(line)):
+            return re.findall(r"\b(?:REF|TAB)-\d+\b", line)
+    return []
+
+def build_chapter_inputs(chapter_id):
+    """Builds the chapter_creator inputs for a chapter from the current skeleton and mappings."""
+    # With per-chapter mappings on, a chapter gets just the references the skeleton assigns it, their citations
+    # and its tables, if they're all in the mapping; otherwise the whole Merger output
+    mapping = st.session_state.mapping_combined
+    chapter_view = None
+    if st.session_state.get('chapter_mapping_views') and chapter_id in st.session_state.chapter_sequence:
+        chapter_view = mapping.chapter_view_json(chapter_mapping_ids(chapter_id))
+    if chapter_view is not None:
+        mapeo_contenido = hosted_input(f"mapeo_contenido_{chapter_id}.json", chapter_view, "application/json")
+    else:
+        mapeo_contenido = hosted_input("mapeo_contenido.json", mapping.output_json(), "application/json")
+    
+    # The same compendio, skeleton and mapping go to every chapter, so large ones can be hosted once and passed by URL
+    return {
+        "Skeleton": hosted_input("skeleton.json", json.dumps(st.session_state.skeleton.get('EsqueletoMaestro', {})), "application/json"),
+        "CompendioMd": hosted_input("compendio.md", st.session_state.compendio_md),
+        "previous_context": "",
+        "capituloConstruir": chapter_id,
+        "mapeoContenido": mapeo_contenido
+    }
+
+def store_generated_chapter(chapter_id, result):
+    """Saves a chapter_creator result. Returns False if the response was malformed."""
+    generated_chapter = result.get('generatedChapter', {})
+    chapter_data = generated_chapter.get('chapterTitle', {})
+    if not chapter_data:
+        return False
+    
+    st.session_state.generated_chapters[chapter_id] = chapter_data.copy()
+    if chapter_id not in st.session_state.chapters_completed:
+        st.session_state.chapters_completed.append(chapter_id)
+    return True
+
+def generate_pending_chapters(pending_chapters):
+    """Generates all pending chapters concurrently, each streaming into its own panel. Returns the ones that failed."""
+    failed = run_pipeline([f"chapter:{chapter_id}" for chapter_id in pending_chapters], max_concurrency=CHAPTER_BATCH_CONCURRENCY, priority="bulk")
+    return [name.split(":", 1)[1] for name in failed if name.startswith("chapter:")]
+
 def render_stage_4():
     st.header("Stage 4: Chapter Generation")
     st.markdown("Generate chapters in any order. Edit parameters before generation and regenerate any chapter as needed.")
@@ -2406,6 +5156,26 @@ def render_stage_4():
     if 'edit_modes' not in st.session_state:
         st.session_state.edit_modes = {}
 
+    st.toggle(
+        "Mapeo por capítulo",
+        key='chapter_mapping_views',
+        help="Envía a cada capítulo solo las referencias que el esqueleto le asigna (con sus citas) y sus tablas, "
+             "en lugar del mapeo completo. Las citas de referencias no asignadas no se envían."
+    )
+
+    # --- BATCH GENERATION ---
+    pending_chapters = [c for c in st.session_state.chapter_sequence if c not in st.session_state.generated_chapters]
+    if len(pending_chapters) > 1:
+        if st.button(f"⏩ Generar Todos los Pendientes ({len(pending_chapters)})", use_container_width=True, help=f"Genera hasta {CHAPTER_BATCH_CONCURRENCY} capítulos en paralelo"):
+            failed = generate_pending_chapters(pending_chapters)
+            if failed:
+                st.error(f"❌ No se pudieron generar: {', '.join(failed)}")
+            else:
+                st.success("✅ Todos los capítulos pendientes generados!")
+                st.balloons()
+                time.sleep(2)
+                st.rerun()
+
     st.divider()
 
     esqueleto = st.session_state.skeleton.get('EsqueletoMaestro', {}).get('esqueletoLogica', {})
@@ -2420,8 +5190,13 @@ def render_stage_4():
         is_content_edit_mode = st.session_state.edit_modes.get(chapter_id, False)
         
         status = "✅ Generado" if chapter_exists else "⚪ Pendiente"
+        is_stale = chapter_exists and st.session_state.pipeline_status.get(f"chapter:{chapter_id}") == 'stale'
+        if is_stale:
+            status = "⚠️ Desactualizado"
         
         st.subheader(f"{status} {chapter_title}")
+        if is_stale:
+            st.caption("El esqueleto, el mapeo o el compendio cambiaron después de generar este capítulo. Regenéralo para usarlos.")
         
         # --- PARAMETER EDITING SECTION ---
         show_params = (not chapter_exists) or is_editing_this
@@ -2660,40 +5435,17 @@ def render_stage_4():
                                 status_placeholder = st.empty()
                                 status_placeholder.info(f"🔄 Regenerando {chapter_id}...")
                                 
-                                # Get Merger output from mapping_combined
-                                mapeo_contenido = st.session_state.mapping_combined.get('Merger', {}).get('output', st.session_state.mapping_combined)
-                                
-                                inputs = {
-                                    "Skeleton": json.dumps(st.session_state.skeleton.get('EsqueletoMaestro', {})),
-                                    "CompendioMd": st.session_state.compendio_md,
-                                    "previous_context": "",
-                                    "capituloConstruir": chapter_id,
-                                    "mapeoContenido": json.dumps(mapeo_contenido)
-                                }
-                                
-                                stream_container = st.empty()
-                                result = process_wordware_api(APP_IDS["chapter_creator"], inputs, stream_container)
+                                failed = run_pipeline([f"chapter:{chapter_id}"], rerun=[f"chapter:{chapter_id}"])
                                 
                                 status_placeholder.empty()
                                 
-                                if result:
-                                    generated_chapter = result.get('generatedChapter', {})
-                                    chapter_data = generated_chapter.get('chapterTitle', {})
-                                    
-                                    if chapter_data:
-                                        st.session_state.generated_chapters[chapter_id] = chapter_data.copy()
-                                        
-                                        if chapter_id not in st.session_state.chapters_completed:
-                                            st.session_state.chapters_completed.append(chapter_id)
-                                        
-                                        st.success(f"✅ {chapter_id} regenerado exitosamente!")
-                                        st.balloons()
-                                        time.sleep(2)
-                                        st.rerun()
-                                    else:
-                                        st.error("❌ Respuesta malformada del API")
+                                if not failed:
+                                    st.success(f"✅ {chapter_id} regenerado exitosamente!")
+                                    st.balloons()
+                                    time.sleep(2)
+                                    st.rerun()
                                 else:
-                                    st.error("❌ Fallo en la llamada al API")
+                                    st.error("❌ Fallo en la llamada al API o respuesta malformada")
                             else:
                                 st.success("✅ Parámetros guardados en el esqueleto maestro!")
                                 st.rerun()
@@ -2709,40 +5461,17 @@ def render_stage_4():
                 status_placeholder = st.empty()
                 status_placeholder.info(f"🔄 Generando {chapter_id}...")
                 
-                # Get Merger output from mapping_combined
-                mapeo_contenido = st.session_state.mapping_combined.get('Merger', {}).get('output', st.session_state.mapping_combined)
-                
-                inputs = {
-                    "Skeleton": json.dumps(st.session_state.skeleton.get('EsqueletoMaestro', {})),
-                    "CompendioMd": st.session_state.compendio_md,
-                    "previous_context": "",
-                    "capituloConstruir": chapter_id,
-                    "mapeoContenido": json.dumps(mapeo_contenido)
-                }
-                
-                stream_container = st.empty()
-                result = process_wordware_api(APP_IDS["chapter_creator"], inputs, stream_container)
+                failed = run_pipeline([f"chapter:{chapter_id}"], rerun=[f"chapter:{chapter_id}"])
                 
                 status_placeholder.empty()
                 
-                if result:
-                    generated_chapter = result.get('generatedChapter', {})
-                    chapter_data = generated_chapter.get('chapterTitle', {})
-                    
-                    if chapter_data:
-                        st.session_state.generated_chapters[chapter_id] = chapter_data.copy()
-                        
-                        if chapter_id not in st.session_state.chapters_completed:
-                            st.session_state.chapters_completed.append(chapter_id)
-                        
-                        st.success(f"✅ {chapter_id} generado exitosamente!")
-                        st.balloons()
-                        time.sleep(2)
-                        st.rerun()
-                    else:
-                        st.error("❌ Respuesta malformada del API")
+                if not failed:
+                    st.success(f"✅ {chapter_id} generado exitosamente!")
+                    st.balloons()
+                    time.sleep(2)
+                    st.rerun()
                 else:
-                    st.error("❌ Fallo en la llamada al API")
+                    st.error("❌ Fallo en la llamada al API o respuesta malformada")
         
         # --- CHAPTER REVIEW ---
         if chapter_exists:
@@ -2789,6 +5518,32 @@ def render_stage_4():
         st.success("✅ Todos los capítulos generados. Procede a Stage 5.")
 
 #---- Stage 5: Final Ebook Assembly ---
+def build_assembly_inputs():
+    """table_generator inputs: every generated chapter, in order, plus the skeleton."""
+    all_chapters_content = "\n\n---\n\n".join(
+        [ch.get('contenido_capitulo', '') for id, ch in sorted(st.session_state.generated_chapters.items())]
+    )
+    return {
+        "GeneratedEbook": all_chapters_content,
+        "EsqueletoMaestro": json.dumps(st.session_state.skeleton.get('EsqueletoMaestro', {}))
+    }
+
+def store_final_ebook(result):
+    """Saves a table_generator result as the final ebook."""
+    # Handle non-structured generation response
+    if isinstance(result, dict):
+        # Get the first string value from the dictionary
+        for key, value in result.items():
+            if isinstance(value, str):
+                st.session_state.final_ebook = value
+                break
+        else:
+            # If no string values found, convert entire dict to string
+            st.session_state.final_ebook = str(result)
+    else:
+        st.session_state.final_ebook = result
+    return True
+
 def render_stage_5():
     st.header("Stage 5: Final Ebook Assembly")
     st.markdown("This final stage will assemble all generated chapters, create a table of contents, and produce the complete ebook in Markdown format.")
@@ -2799,34 +5554,9 @@ def render_stage_5():
 
     if st.button("Assemble Final Ebook", type="primary"):
         st.session_state.stage_5_status = 'in_progress'
-        
-        all_chapters_content = "\n\n---\n\n".join(
-            [ch.get('contenido_capitulo', '') for id, ch in sorted(st.session_state.generated_chapters.items())]
-        )
-        
-        inputs = {
-            "GeneratedEbook": all_chapters_content,
-            "EsqueletoMaestro": json.dumps(st.session_state.skeleton.get('EsqueletoMaestro', {}))
-        }
 
         st.info("Assembling the final ebook... This may take a moment.")
-        stream_container = st.empty()
-        result = process_wordware_api(APP_IDS["table_generator"], inputs, stream_container)
-
-        if result:
-            # Handle non-structured generation response
-            if isinstance(result, dict):
-                # Get the first string value from the dictionary
-                for key, value in result.items():
-                    if isinstance(value, str):
-                        st.session_state.final_ebook = value
-                        break
-                else:
-                    # If no string values found, convert entire dict to string
-                    st.session_state.final_ebook = str(result)
-            else:
-                st.session_state.final_ebook = result
-            
+        if not run_pipeline(["final_ebook"], rerun=["final_ebook"]):
             st.session_state.stage_5_status = 'completed'
             st.success("🎉 Ebook Generation Complete! 🎉")
             st.balloons()
@@ -2847,6 +5577,79 @@ def render_stage_5():
         with st.expander("Preview Final Ebook", expanded=True):
             st.markdown(st.session_state.final_ebook)
 
+#---- Admin: Call Metrics ---
+METRICS_DURATION_BUCKETS = [0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600]  # seconds
+
+def bucket_counts(values, edges):
+    """Counts values into histogram buckets labelled by their upper edge."""
+    labels = [f"≤{edge}s" for edge in edges] + [f">{edges[-1]}s"]
+    counts = dict.fromkeys(labels, 0)
+    for value in values:
+        index = next((i for i, edge in enumerate(edges) if value <= edge), len(edges))
+        counts[labels[index]] += 1
+    return counts
+
+def render_metrics_dashboard():
+    st.header("📈 Call Metrics")
+    st.markdown("Latency and throughput of every Wordware and LlamaParse call made by this app, across all sessions.")
+
+    records = load_call_metrics()
+    if not records:
+        st.info("No calls recorded yet.")
+        return
+
+    apps = sorted({record["app"] for record in records})
+    summary = []
+    for app in apps:
+        app_records = [r for r in records if r["app"] == app]
+        durations = [r["duration"] for r in app_records if r["outcome"] == "ok"]
+        ttfbs = [r["ttfb"] for r in app_records if r["outcome"] == "ok" and r.get("ttfb") is not None]
+        streamed_time = sum(durations)
+        summary.append({
+            "App": app,
+            "Calls": len(app_records),
+            "Errors": sum(1 for r in app_records if r["outcome"] == "error"),
+            "Cached": sum(1 for r in app_records if r["outcome"] == "cached"),
+            "Cancelled": sum(1 for r in app_records if r["outcome"] == "cancelled"),
+            "Abandoned": sum(1 for r in app_records if r["outcome"] in ("abandoned", "cleared")),
+            "p50 (s)": round(percentile(durations, 50), 2),
+            "p95 (s)": round(percentile(durations, 95), 2),
+            "p95 first chunk (s)": round(percentile(ttfbs, 95), 2),
+            "Avg request (KB)": round(sum(r["request_bytes"] for r in app_records) / len(app_records) / 1024, 1),
+            "Avg output (KB)": round(sum(r["output_bytes"] for r in app_records) / len(app_records) / 1024, 1),
+            "Chunks/s": round(sum(r["chunks"] for r in app_records if r["outcome"] == "ok") / streamed_time, 1) if streamed_time else 0.0
+        })
+    st.caption(f"Last {len(records)} calls · latency percentiles exclude cache hits and failures")
+    st.dataframe(summary, use_container_width=True, hide_index=True)
+
+    st.subheader("Latency Distribution")
+    selected_app = st.selectbox("App", apps, key="metrics_app")
+    app_records = [r for r in records if r["app"] == selected_app and r["outcome"] == "ok"]
+    col1, col2 = st.columns(2)
+    with col1:
+        st.markdown("**Total duration**")
+        st.bar_chart(bucket_counts([r["duration"] for r in app_records], METRICS_DURATION_BUCKETS))
+    with col2:
+        st.markdown("**Time to first chunk**")
+        st.bar_chart(bucket_counts([r["ttfb"] for r in app_records if r.get("ttfb") is not None], METRICS_DURATION_BUCKETS))
+
+    st.subheader("Slowest Recent Calls")
+    slowest = sorted(records, key=lambda r: r["duration"], reverse=True)[:10]
+    st.dataframe([{
+        "Time": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(r["start"])),
+        "App": r["app"],
+        "Duration (s)": round(r["duration"], 2),
+        "First chunk (s)": round(r["ttfb"], 2) if r.get("ttfb") is not None else None,
+        "Queue wait (s)": round(r.get("queue_wait", 0.0), 2),
+        "Attempts": r["attempts"],
+        "Request (KB)": round(r["request_bytes"] / 1024, 1),
+        "Output (KB)": round(r["output_bytes"] / 1024, 1),
+        "Outcome": r["outcome"]
+    } for r in slowest], use_container_width=True, hide_index=True)
+
+    with open(METRICS_FILE, 'rb') as f:
+        st.download_button("Download metrics log (JSONL)", data=f.read(), file_name="calls.jsonl", mime="application/x-ndjson")
+
 # --- MAIN APPLICATION LOGIC ---
 
 def main():
@@ -2861,8 +5664,11 @@ def main():
     st.markdown("Follow the stages in the sidebar to transform your source documents into a complete ebook.")
 
     initialize_session_state()
+    cancel_session_jobs()
     render_sidebar()
     render_progress_indicator()
+    if st.session_state.background_parses:
+        render_background_parses()
 
     # Main content area based on the current stage
     if st.session_state.current_stage == 1:
@@ -2875,6 +5681,8 @@ def main():
         render_stage_4()
     elif st.session_state.current_stage == 5:
         render_stage_5()
+    elif st.session_state.current_stage == 'metrics':
+        render_metrics_dashboard()
 
 if __name__ == "__main__":
     main()
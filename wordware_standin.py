@@ -0,0 +1,260 @@
+"""
+Local stand-in for the Wordware released-app API, for benchmarking and testing the pipeline offline.
+
+It speaks the same POST /{app_id}/run protocol as Wordware: an NDJSON stream of
+{"type": "chunk", "value": {...}} records, where value.type is 'chunk' for streamed text
+and 'outputs' for the final result.
+
+Modes:
+    record  Proxies every call to the real API and saves the stream (with its timing) to disk.
+    replay  Serves saved streams. Calls with no recording for their exact inputs get the most
+            recent recording for the same app, or a synthetic stream if the app has none.
+
+Point the app at it by setting API_BASE_URL in .streamlit/secrets.toml or the environment:
+    python wordware_standin.py replay --port 8765 --chunk-rate 200 --fail-rate 0.1
+    API_BASE_URL=http://127.0.0.1:8765 streamlit run geminiChapter.py
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDWARE_API_BASE_URL = "https://app.wordware.ai/api/released-app"
+DEFAULT_RECORDINGS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "recordings")
+
+# --- RECORDINGS ---
+
+def request_key(app_id, inputs):
+    """Same content hash geminiChapter.wordware_request_key uses for runs against the real API."""
+    canonical = json.dumps({"app_id": app_id, "inputs": inputs}, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def recording_path(recordings_dir, app_id, key):
+    return os.path.join(recordings_dir, app_id, f"{key}.ndjson")
+
+def save_recording(path, records):
+    """Writes (offset, record) pairs atomically, one {"t", "record"} line each."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for offset, record in records:
+            f.write(json.dumps({"t": offset, "record": record}, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
+
+def load_recording(path):
+    """Returns the (offset, record) pairs saved by save_recording."""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [(line["t"], line["record"]) for line in map(json.loads, f) if line]
+
+def find_recording(recordings_dir, app_id, key):
+    """Returns the recording for these exact inputs, else the app's most recent one, else None."""
+    exact = recording_path(recordings_dir, app_id, key)
+    if os.path.exists(exact):
+        return exact
+    app_dir = os.path.join(recordings_dir, app_id)
+    if not os.path.isdir(app_dir):
+        return None
+    candidates = [os.path.join(app_dir, name) for name in os.listdir(app_dir) if name.endswith('.ndjson')]
+    return max(candidates, key=os.path.getmtime) if candidates else None
+
+def synthetic_stream(app_id, inputs, chunk_count):
+    """A stand-in stream for apps with no recording: lorem chunks followed by an echo of the inputs."""
+    words = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor".split()
+    text = []
+    records = []
+    for i in range(chunk_count):
+        chunk = words[i % len(words)] + " "
+        text.append(chunk)
+        records.append((None, {"type": "chunk", "value": {"type": "chunk", "value": chunk}}))
+    output = {"output": "".join(text), "app_id": app_id, "inputs": sorted(inputs)}
+    records.append((None, {"type": "chunk", "value": {"type": "outputs", "values": output}}))
+    return records
+
+# --- SERVER ---
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """Serves POST /{app_id}/run; configuration lives on the server object."""
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) != 2 or parts[1] != 'run':
+            self.send_json_error(404, {"error": f"Unknown path {self.path}"})
+            return
+        app_id = parts[0]
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            inputs = json.loads(body).get('inputs', {})
+        except json.JSONDecodeError:
+            self.send_json_error(400, {"error": "Request body is not valid JSON"})
+            return
+
+        if self.server.mode == 'record':
+            self.proxy_and_record(app_id, inputs, body)
+        else:
+            self.replay(app_id, inputs)
+
+    def send_json_error(self, status, payload, headers=None):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def start_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def write_line(self, record):
+        data = (json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8')
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def end_stream(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def proxy_and_record(self, app_id, inputs, body):
+        """Forwards the call to the real API, streaming it back while saving it."""
+        request = urllib.request.Request(
+            f"{self.server.upstream}/{app_id}/run",
+            data=body,
+            headers={"Authorization": self.headers.get("Authorization", ""), "Content-Type": "application/json"},
+            method="POST"
+        )
+        start_time = time.time()
+        try:
+            response = urllib.request.urlopen(request, timeout=self.server.upstream_timeout)
+        except urllib.error.HTTPError as e:
+            # Errors are passed through but never recorded
+            data = e.read()
+            self.send_response(e.code)
+            self.send_header("Content-Type", e.headers.get("Content-Type", "application/json"))
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        records = []
+        self.start_stream()
+        with response:
+            for raw_line in response:
+                if not raw_line.strip():
+                    continue
+                try:
+                    record = json.loads(raw_line)
+                except json.JSONDecodeError:
+                    continue
+                records.append((time.time() - start_time, record))
+                self.write_line(record)
+        self.end_stream()
+        path = recording_path(self.server.recordings_dir, app_id, request_key(app_id, inputs))
+        save_recording(path, records)
+        self.log_message("recorded %s (%d lines) to %s", app_id, len(records), path)
+
+    def replay(self, app_id, inputs):
+        """Serves a saved or synthetic stream, applying the configured latency, pacing and faults."""
+        server = self.server
+        path = find_recording(server.recordings_dir, app_id, request_key(app_id, inputs))
+        if path:
+            records = load_recording(path)
+        elif server.strict:
+            self.send_json_error(404, {"error": f"No recording for app {app_id}"})
+            return
+        else:
+            records = synthetic_stream(app_id, inputs, server.synthetic_chunks)
+
+        rng = server.rng
+        with server.rng_lock:
+            fail = rng.random() < server.fail_rate
+            drop_at = int(rng.random() * len(records)) if rng.random() < server.drop_rate else None
+            stall_at = int(rng.random() * len(records)) if rng.random() < server.stall_rate else None
+
+        time.sleep(server.latency)
+        if fail:
+            self.send_json_error(server.fail_status, {"error": "Injected failure"}, {"Retry-After": str(server.retry_after)} if server.retry_after else None)
+            return
+
+        self.start_stream()
+        start_time = time.time()
+        for i, (offset, record) in enumerate(records):
+            if i == drop_at:
+                # Cut the connection mid-stream, without the terminating chunk
+                self.close_connection = True
+                self.connection.shutdown(2)
+                return
+            if i == stall_at:
+                time.sleep(server.stall_seconds)
+            if server.chunk_rate:
+                time.sleep(1 / server.chunk_rate)
+            elif offset is not None:
+                # Reproduce the recorded timing
+                time.sleep(max(0.0, offset - (time.time() - start_time)))
+            self.write_line(record)
+        self.end_stream()
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Wordware released-app API.")
+    parser.add_argument("mode", choices=["record", "replay"], help="record proxies to Wordware and saves streams; replay serves them")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--recordings-dir", default=DEFAULT_RECORDINGS_DIR)
+    parser.add_argument("--upstream", default=WORDWARE_API_BASE_URL, help="API to proxy to in record mode")
+    parser.add_argument("--upstream-timeout", type=float, default=1600)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before the response starts")
+    parser.add_argument("--chunk-rate", type=float, default=0.0, help="lines per second (0 = recorded timing, or as fast as possible for synthetic streams)")
+    parser.add_argument("--synthetic-chunks", type=int, default=200, help="chunks in a synthetic stream")
+    parser.add_argument("--strict", action="store_true", help="return 404 for apps with no recording instead of a synthetic stream")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of calls answered with --fail-status")
+    parser.add_argument("--fail-status", type=int, default=503)
+    parser.add_argument("--retry-after", type=int, default=0, help="Retry-After seconds sent with injected failures (0 = omit)")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="fraction of streams cut off mid-way")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="fraction of streams that go silent mid-way")
+    parser.add_argument("--stall-seconds", type=float, default=600.0)
+    parser.add_argument("--seed", type=int, default=None, help="seed for fault injection, for reproducible runs")
+    parser.add_argument("--quiet", action="store_true")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), StandinHandler)
+    server.daemon_threads = True
+    server.mode = args.mode
+    server.recordings_dir = args.recordings_dir
+    server.upstream = args.upstream.rstrip('/')
+    server.upstream_timeout = args.upstream_timeout
+    server.latency = args.latency
+    server.chunk_rate = args.chunk_rate
+    server.synthetic_chunks = args.synthetic_chunks
+    server.strict = args.strict
+    server.fail_rate = args.fail_rate
+    server.fail_status = args.fail_status
+    server.retry_after = args.retry_after
+    server.drop_rate = args.drop_rate
+    server.stall_rate = args.stall_rate
+    server.stall_seconds = args.stall_seconds
+    server.rng = random.Random(args.seed)
+    server.rng_lock = threading.Lock()
+    server.quiet = args.quiet
+
+    print(f"Wordware stand-in ({args.mode}) on http://{args.host}:{args.port} · recordings in {args.recordings_dir}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()